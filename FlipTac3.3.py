@@ -38,6 +38,10 @@ size = 5
 # ダークモード(1で有効)
 darkmode = 1
 
+# CPUの思考(1: αβ探索, 0: 1手読みのshortest)と、αβ探索の思考時間(ミリ秒)
+cpu_search = 1
+cpu_think_ms = 50
+
 
 
 
@@ -47,6 +51,15 @@ import random
 from playsound3 import playsound
 import threading
 import time
+import os
+import sys
+
+# 有効手の候補生成は fliptac_pytorch/movegen.py を学習環境と共有する
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "fliptac_pytorch"))
+from movegen import candidate_moves
+from FlipTacEnv import FlipTacEnv, Position
+from search import AlphaBetaPlayer
+from tablebase import Tablebase, TablebasePlayer
 
 
 def play_sound(filename):
@@ -110,6 +123,17 @@ def is_valid_move(player, row, col):
     return False
 
 
+# 有効手の一覧（最後に置いたマスの近傍、初手は外周だけを調べる）
+def valid_moves(player):
+    moves = []
+    for row, col, jump_over in candidate_moves(size, last_move[player]):
+        if board[row][col] is not None:
+            continue
+        if jump_over is None or board[jump_over[0]][jump_over[1]] not in (None, player):
+            moves.append((row, col))
+    return moves
+
+
 # ボタンがクリックされた時の処理
 def button_click(row, col):
     global current_player_idx
@@ -128,11 +152,7 @@ def button_click(row, col):
 
 # 詰み判定
 def check_no_moves(player):
-    for row in range(size):
-        for col in range(size):
-            if board[row][col] is None and is_valid_move(player, row, col):
-                return False
-    return True
+    return not valid_moves(player)
 
 
 # 勝利判定
@@ -173,12 +193,9 @@ def cpu_move():
             wait = False
 
     if cpu_move_count < 3:
-        empty_tiles = []
-        for row in range(size):
-            for col in range(size):
-                if board[row][col] == None and is_valid_move(marks[current_player_idx], row, col):
-                    empty_tiles.append((row,col))
-        row, col = random.choice(empty_tiles)
+        row, col = random.choice(valid_moves(marks[current_player_idx]))
+    elif cpu_search == 1:
+        row, col = search_move()
     else:
         row, col = shortest()
 
@@ -190,20 +207,56 @@ def cpu_move():
     settle()
 
 
+# 探索用の仮の着手と取り消し（盤面とlast_moveを元に戻す）
+undo_stack = []
+
+def make_move(player, row, col):
+    undo_stack.append((player, row, col, last_move[player]))
+    board[row][col] = player
+    last_move[player] = (row, col)
+
+
+def unmake_move():
+    player, row, col, previous_last = undo_stack.pop()
+    board[row][col] = None
+    last_move[player] = previous_last
+
+
+# αβ探索でCPU(X)の手を決める関数
+alpha_beta = AlphaBetaPlayer(time_limit_ms=cpu_think_ms)
+cpu_player = alpha_beta
+
+# fliptac_pytorch/tablebase.py で作った完全解析表があれば、表に載っている局面は最善手を打つ
+tablebase_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fliptac_pytorch", f"fliptac_tablebase_{size}x{size}")
+if os.path.exists(os.path.join(tablebase_dir, "tablebase.json")):
+    cpu_player = TablebasePlayer(Tablebase(tablebase_dir), fallback=alpha_beta)
+
+def search_move():
+    stones = {"X": 0, "O": 0}
+    for row in range(size):
+        for col in range(size):
+            if board[row][col] in stones:
+                stones[board[row][col]] |= 1 << (row * size + col)
+    last = {player: None if last_move[player] is None else last_move[player][0] * size + last_move[player][1]
+            for player in ("X", "O")}
+    env = FlipTacEnv(size=size, use_bitboard=True)
+    env.restore(Position(stones["X"], stones["O"], last["X"], last["O"], 1))
+    return cpu_player.select_move(env)
+
+
 # 最短距離の手を計算する関数
 def shortest():
     opponent = "O" if current_player_idx == 0 else "X"
-    valid_moves = [(row, col) for row in range(size) for col in range(size)
-                   if board[row][col] is None and is_valid_move(marks[current_player_idx], row, col)]
-    if valid_moves:
+    player = marks[current_player_idx]
+    moves = valid_moves(player)
+    if moves:
         move_counts = []
-        for move in valid_moves:
+        for move in moves:
             row, col = move
-            board[row][col] = marks[current_player_idx]
-            last_move[marks[current_player_idx]] = (row, col)
+            make_move(player, row, col)
             move_count = count_valid_moves(opponent)
             move_counts.append((move_count, move))
-            board[row][col] = None
+            unmake_move()
 
         # 相手が最後にマークを置いた位置
         last_opponent_move = last_move[opponent]
@@ -231,16 +284,12 @@ def shortest():
 
 # 有効手の数を数える関数
 def count_valid_moves(player):
-    count = 0
-    for row in range(size):
-        for col in range(size):
-            if board[row][col] is None and is_valid_move(player, row, col):
-                count += 1
-    return count
+    return len(valid_moves(player))
 
 
 # ゲーム画面の更新
 def update_board():
+    current_valid_moves = set(valid_moves(marks[current_player_idx]))
     for row in range(size):
         for col in range(size):
             if board[row][col] is not None:
@@ -253,7 +302,7 @@ def update_board():
                 color = '#fef263'
             elif board[row][col] == "#":
                 color = "#ff7ff9"
-            elif board[row][col] is None and is_valid_move(marks[current_player_idx], row, col):
+            elif (row, col) in current_valid_moves:
                 color = '#b8d200' if darkmode == 1 else '#99ff99'
             else:
                 color = '#2e2930' if darkmode == 1 else '#fdeffb'
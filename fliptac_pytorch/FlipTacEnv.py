@@ -1,22 +1,40 @@
 import numpy as np
 import random
+from collections import namedtuple
+
+from bitboard import Bitboard, mask_to_moves
+from movegen import candidate_moves
+from zobrist import get_keys
+
+# 探索用の軽量な局面スナップショット
+# 石はビットマスク（マス(r, c)が r * size + c 番目のビット）、最後の手はマス番号か None
+Position = namedtuple('Position', ('x_stones', 'o_stones', 'x_last', 'o_last', 'current_player'))
 
 class FlipTacEnv:
     """
     FlipTacのゲーム環境クラス
     自己閉塞ペナルティを追加したバージョン。
+    use_bitboard=True で有効手の生成をビットボード版に切り替える。
     """
-    def __init__(self, size=7, discount_factor=0.99, shaping_factor=0.1):
+    def __init__(self, size=7, discount_factor=0.99, shaping_factor=0.1, use_bitboard=False):
         self.size = size
         self.marks = {1: 'X', -1: 'O'}
         self.gamma = discount_factor
         self.shaping_factor = shaping_factor
+        self.use_bitboard = use_bitboard
+        self._bitboard = Bitboard(size) if use_bitboard else None
+        self._zobrist = get_keys(size)
+        self._action_mask = np.zeros(size * size, dtype=bool)
         self.reset()
 
     def reset(self):
         self.board = np.zeros((self.size, self.size), dtype=int)
         self.last_move = {1: None, -1: None}
         self.current_player = 1
+        self.hash = self._zobrist.initial # 局面のZobristハッシュ（着手・取り消しで差分更新する）
+        self._mobility = None # 現在の盤面での各プレイヤーの有効手数（stepの間で使い回す）
+        self._undo_stack = []
+        if self.use_bitboard: self._bitboard.reset()
         return self._get_state()
     def _get_state(self):
         state = np.zeros((3, self.size, self.size), dtype=np.float32)
@@ -25,13 +43,38 @@ class FlipTacEnv:
         state[2, :, :] = self.current_player
         return state
     def get_valid_moves(self, player):
+        if self.use_bitboard:
+            return mask_to_moves(self._bitboard.valid_mask(player), self.size)
+        # 最後に置いたマスの近傍（初手は外周）だけを調べる
         moves = []
-        for r in range(self.size):
-            for c in range(self.size):
-                if self.is_valid_move(player, r, c):
-                    moves.append((r, c))
+        board = self.board
+        for r, c, jump_over in candidate_moves(self.size, self.last_move[player]):
+            if board[r, c] != 0: continue
+            if jump_over is None or board[jump_over] not in (0, player):
+                moves.append((r, c))
         return moves
+    def legal_mask(self, player=None):
+        """
+        有効手を長さ size*size の bool 配列で返す（player 省略時は現在の手番）
+        返す配列は使い回すので、次に呼ぶと上書きされる。
+        """
+        if player is None: player = self.current_player
+        mask = self._action_mask
+        if self.use_bitboard:
+            n = self.size * self.size
+            bits = self._bitboard.valid_mask(player).to_bytes((n + 7) // 8, 'little')
+            mask[:] = np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=n, bitorder='little')
+        else:
+            mask[:] = False
+            for r, c in self.get_valid_moves(player):
+                mask[r * self.size + c] = True
+        return mask
+    def count_valid_moves(self, player):
+        if self.use_bitboard: return self._bitboard.count_valid_moves(player)
+        return len(self.get_valid_moves(player))
     def is_valid_move(self, player, row, col):
+        if self.use_bitboard:
+            return (self._bitboard.valid_mask(player) >> (row * self.size + col)) & 1 == 1
         if self.board[row, col] != 0: return False
         last_pos = self.last_move[player]
         if last_pos is None: return row == 0 or row == self.size - 1 or col == 0 or col == self.size - 1
@@ -44,47 +87,98 @@ class FlipTacEnv:
             jump_over_pos = self.board[(lr + row) // 2, col]
             return jump_over_pos != 0 and jump_over_pos != player
         return False
-    def _calculate_potential(self, player):
-        my_moves = len(self.get_valid_moves(player))
-        opponent_moves = len(self.get_valid_moves(-player))
-        return my_moves - (opponent_moves * 1.5)
+    def _place(self, player, row, col):
+        keys = self._zobrist
+        self.hash ^= keys.cells[player][row * self.size + col] ^ keys.last_key(player, self.last_move[player]) ^ keys.last_key(player, (row, col))
+        self.board[row, col] = player
+        self.last_move[player] = (row, col)
+        if self.use_bitboard: self._bitboard.place(player, row * self.size + col)
+    def _remove(self, player, row, col, previous_last):
+        keys = self._zobrist
+        self.hash ^= keys.cells[player][row * self.size + col] ^ keys.last_key(player, (row, col)) ^ keys.last_key(player, previous_last)
+        self.board[row, col] = 0
+        self.last_move[player] = previous_last
+        if self.use_bitboard:
+            self._bitboard.remove(player, row * self.size + col,
+                                  None if previous_last is None else previous_last[0] * self.size + previous_last[1])
+
+    # ===============================================================
+    # 探索用の着手/取り消しAPI（報酬は計算しない）
+    # ===============================================================
+    def make_move(self, action):
+        """現在の手番で action=(row, col) を打つ。有効手かどうかは確認しない"""
+        row, col = action
+        player = self.current_player
+        self._undo_stack.append((row, col, self.last_move[player], self._mobility))
+        self._place(player, row, col)
+        self.current_player = -player
+        self.hash ^= self._zobrist.side
+        self._mobility = None
+    def unmake_move(self):
+        """直前の make_move を取り消す"""
+        row, col, previous_last, previous_mobility = self._undo_stack.pop()
+        player = -self.current_player
+        self._remove(player, row, col, previous_last)
+        self.current_player = player
+        self.hash ^= self._zobrist.side
+        self._mobility = previous_mobility
+    def snapshot(self):
+        if self.use_bitboard:
+            stones, last = self._bitboard.stones, self._bitboard.last
+            return Position(stones[1], stones[-1], last[1], last[-1], self.current_player)
+        flat = self.board.ravel()
+        x_stones = sum(1 << int(i) for i in np.flatnonzero(flat == 1))
+        o_stones = sum(1 << int(i) for i in np.flatnonzero(flat == -1))
+        x_last, o_last = [None if self.last_move[p] is None else self.last_move[p][0] * self.size + self.last_move[p][1]
+                          for p in (1, -1)]
+        return Position(x_stones, o_stones, x_last, o_last, self.current_player)
+    def restore(self, position):
+        """snapshot() で保存した局面に戻す（取り消し履歴は消える）"""
+        self.reset()
+        for player, stones, last in ((1, position.x_stones, position.x_last), (-1, position.o_stones, position.o_last)):
+            while stones:
+                low = stones & -stones
+                self._place(player, *divmod(low.bit_length() - 1, self.size))
+                stones ^= low
+            self.last_move[player] = None if last is None else divmod(last, self.size)
+            if self.use_bitboard: self._bitboard.last[player] = last
+        self.current_player = position.current_player
+        self.hash = self._zobrist.hash_position(position)
+        return self._get_state()
+
+    def _mobility_counts(self):
+        if self._mobility is None:
+            self._mobility = {p: self.count_valid_moves(p) for p in (1, -1)}
+        return self._mobility
     
     def step(self, action):
         row, col = action
         player = self.current_player
 
-        potential_before = self._calculate_potential(player)
+        # 行動前の有効手数は前回のstepで数えたものを使い回す
+        mobility = self._mobility_counts()
+        potential_before = mobility[player] - (mobility[-player] * 1.5)
 
         if not self.is_valid_move(player, row, col):
             return self._get_state(), -20.0, True, {}
 
-        # ---
-        # 盤面を仮に進めて、行動後の有効手数を確認する
-        temp_board = np.copy(self.board)
-        temp_last_move = self.last_move.copy()
-        temp_board[row, col] = player
-        temp_last_move[player] = (row, col)
-        
-        # is_valid_moveのチェックのため、一時的にselfを書き換えるハック
-        original_board, original_last_move = self.board, self.last_move
-        self.board, self.last_move = temp_board, temp_last_move
-        my_next_moves = self.get_valid_moves(player)
-        self.board, self.last_move = original_board, original_last_move # 元に戻す
-        # ---
-        
-        self.board[row, col] = player
-        self.last_move[player] = (row, col)
-        
+        self._place(player, row, col)
         self.current_player *= -1
+        self.hash ^= self._zobrist.side
         opponent = self.current_player
 
-        potential_after = self._calculate_potential(player)
+        # 行動後の有効手数は自分と相手の1回ずつだけ数え、報酬の各項で共有する
+        my_next_moves = self.count_valid_moves(player)
+        opponent_valid_moves = self.count_valid_moves(opponent)
+        self._mobility = {player: my_next_moves, opponent: opponent_valid_moves}
+
+        potential_after = my_next_moves - (opponent_valid_moves * 1.5)
 
         reward = 0.0
         
         # ▼▼▼ 自己閉塞ペナルティの導入 ▼▼▼
         # 行動後の有効手数が2手以下になったら、強いペナルティを与える
-        if len(my_next_moves) <= 2:
+        if my_next_moves <= 2:
             reward -= 0.5
         # ▲▲▲ ここまで ▲▲▲
 
@@ -98,14 +192,12 @@ class FlipTacEnv:
             if dist <= 4:
                 reward += (1 / (dist + 3)) * 0.2
         
-        opponent_valid_moves = self.get_valid_moves(opponent)
-        
         done = False
         base_reward = 0.0
-        if not opponent_valid_moves:
+        if opponent_valid_moves == 0:
             done, base_reward = True, 1.5
         # 自分の次の手がなくなっても敗北
-        elif not my_next_moves:
+        elif my_next_moves == 0:
             done, base_reward = True, -2.0
         
         reward += base_reward
@@ -0,0 +1,195 @@
+import numpy as np
+
+from movegen import candidate_moves
+
+class VecFlipTacEnv:
+    """
+    N個のFlipTacをまとめて進めるベクトル化環境
+    盤面は (N, size, size) の int8 配列、last_move は (N, 2, 2) の配列
+    （[:, 0] が X(1)、[:, 1] が O(-1)、未着手は -1）で保持する。
+    報酬は FlipTacEnv.step と同じ計算で、終了したゲームは自動でリセットされる。
+    """
+    def __init__(self, num_envs, size=7, discount_factor=0.99, shaping_factor=0.1):
+        self.num_envs = num_envs
+        self.size = size
+        self.gamma = discount_factor
+        self.shaping_factor = shaping_factor
+
+        n = size * size
+        # 最後に置いたマスごとの候補表（最大12マス）。余りは常に埋まっている番兵マス n を指す
+        self._dest = np.full((n, 12), n, dtype=np.int64)
+        self._jump_over = np.full((n, 12), n, dtype=np.int64)
+        self._is_jump = np.zeros((n, 12), dtype=bool)
+        for r in range(size):
+            for c in range(size):
+                for k, (rr, cc, jump_over) in enumerate(candidate_moves(size, (r, c))):
+                    self._dest[r * size + c, k] = rr * size + cc
+                    if jump_over is not None:
+                        self._jump_over[r * size + c, k] = jump_over[0] * size + jump_over[1]
+                        self._is_jump[r * size + c, k] = True
+        self._edge = np.zeros(n, dtype=bool)
+        for r, c, _ in candidate_moves(size, None):
+            self._edge[r * size + c] = True
+        self._corner = np.zeros(n, dtype=bool)
+        self._corner[[0, size - 1, n - size, n - 1]] = True
+
+        self._rows = np.arange(num_envs)
+        self.board = np.zeros((num_envs, size, size), dtype=np.int8)
+        self.last_move = np.full((num_envs, 2, 2), -1, dtype=np.int64)
+        self.current_player = np.ones(num_envs, dtype=np.int8)
+        self._mask = None
+        self.reset()
+
+    def reset(self):
+        self._reset_games(self._rows)
+        return self._get_state()
+
+    def _reset_games(self, games):
+        self.board[games] = 0
+        self.last_move[games] = -1
+        self.current_player[games] = 1
+        self._mask = None
+
+    def _get_state(self):
+        cp = self.current_player[:, None, None]
+        state = np.empty((self.num_envs, 3, self.size, self.size), dtype=np.float32)
+        state[:, 0] = self.board == cp
+        state[:, 1] = self.board == -cp
+        state[:, 2] = cp
+        return state
+
+    def _legal_masks(self, players):
+        """各ゲームで players[i] が置けるマスを (N, size*size) の bool 配列で返す"""
+        n = self.size * self.size
+        cells = np.empty((self.num_envs, n + 1), dtype=np.int8)
+        cells[:, :n] = self.board.reshape(self.num_envs, n)
+        cells[:, n] = 2 # 番兵マス
+
+        last = self.last_move[self._rows, (players == -1).astype(np.int64)]
+        has_last = last[:, 0] >= 0
+        last_idx = np.where(has_last, last[:, 0] * self.size + last[:, 1], 0)
+
+        dest = self._dest[last_idx]
+        dest_cells = np.take_along_axis(cells, dest, axis=1)
+        jump_over_cells = np.take_along_axis(cells, self._jump_over[last_idx], axis=1)
+        ok = (dest_cells == 0) & (~self._is_jump[last_idx] | (jump_over_cells == -players[:, None]))
+
+        mask = np.zeros((self.num_envs, n + 1), dtype=bool)
+        mask[self._rows[:, None], dest] = ok
+        mask = mask[:, :n]
+        first = ~has_last
+        if first.any():
+            mask[first] = self._edge & (cells[first, :n] == 0)
+        return mask
+
+    def legal_mask(self):
+        """現在の手番のプレイヤーの有効手マスク (N, size*size)"""
+        if self._mask is None:
+            self._mask = self._legal_masks(self.current_player)
+        return self._mask
+
+    def last_move_planes(self):
+        """現在の手番のプレイヤーが最後に置いたマスだけ 1 の (N, 1, size, size) 配列（初手のゲームはすべて 0）"""
+        last = self.last_move[self._rows, (self.current_player == -1).astype(np.int64)]
+        planes = np.zeros((self.num_envs, 1, self.size, self.size), dtype=np.float32)
+        games = np.flatnonzero(last[:, 0] >= 0)
+        planes[games, 0, last[games, 0], last[games, 1]] = 1
+        return planes
+
+    def step(self, actions):
+        """
+        actions: 各ゲームで打つマスのインデックス (row * size + col) の配列
+        戻り値: (state, reward, done, info)。info['terminal_state'] はリセット前の盤面。
+        """
+        actions = np.asarray(actions, dtype=np.int64)
+        player = self.current_player.copy()
+        rows, cols = np.divmod(actions, self.size)
+
+        my_mask = self.legal_mask()
+        my_moves = my_mask.sum(axis=1)
+        opponent_moves = self._legal_masks(-player).sum(axis=1)
+        potential_before = my_moves - (opponent_moves * 1.5)
+
+        valid = my_mask[self._rows, actions]
+        placed = self._rows[valid]
+        self.board.reshape(self.num_envs, -1)[placed, actions[valid]] = player[valid]
+        side = (player == -1).astype(np.int64)
+        self.last_move[placed, side[valid], 0] = rows[valid]
+        self.last_move[placed, side[valid], 1] = cols[valid]
+        self.current_player[valid] *= -1
+
+        my_next_moves = self._legal_masks(player).sum(axis=1)
+        opponent_mask = self._legal_masks(-player)
+        opponent_valid_moves = opponent_mask.sum(axis=1)
+        potential_after = my_next_moves - (opponent_valid_moves * 1.5)
+
+        reward = np.zeros(self.num_envs, dtype=np.float64)
+        reward -= np.where(my_next_moves <= 2, 0.5, 0.0)
+        reward -= np.where(self._corner[actions], 0.25, 0.0)
+
+        opponent_last = self.last_move[self._rows, 1 - side]
+        dist = np.abs(rows - opponent_last[:, 0]) + np.abs(cols - opponent_last[:, 1])
+        near = (opponent_last[:, 0] >= 0) & (dist <= 4)
+        reward += np.where(near, (1 / (dist + 3)) * 0.2, 0.0)
+
+        win = opponent_valid_moves == 0
+        lose = ~win & (my_next_moves == 0)
+        reward += np.where(win, 1.5, np.where(lose, -2.0, 0.0))
+
+        shaping_reward = (self.gamma * potential_after) - potential_before
+        reward += self.shaping_factor * shaping_reward
+        reward -= 0.01
+
+        # 無効手は即座に敗北扱い
+        reward[~valid] = -20.0
+        done = ~valid | win | lose
+
+        self._mask = opponent_mask
+        terminal_state = self._get_state()
+        if done.any():
+            self._reset_games(self._rows[done])
+        return self._get_state(), reward, done, {'terminal_state': terminal_state}
+
+
+# ===============================================================
+# FlipTacEnv との一致確認とスループット計測: python VecFlipTacEnv.py
+# ===============================================================
+if __name__ == '__main__':
+    import time
+    from FlipTacEnv import FlipTacEnv
+
+    rng = np.random.default_rng(0)
+
+    def random_actions(mask):
+        return (rng.random(mask.shape) * mask).argmax(axis=1)
+
+    for size in (5, 7):
+        num_envs = 64
+        vec_env = VecFlipTacEnv(num_envs, size=size)
+        envs = [FlipTacEnv(size=size) for _ in range(num_envs)]
+        for _ in range(500):
+            mask = vec_env.legal_mask()
+            actions = random_actions(mask)
+            # 時々あえて無効手も打って、ペナルティの一致も確認する
+            actions = np.where(rng.random(num_envs) < 0.01, rng.integers(0, size * size, num_envs), actions)
+            for i, env in enumerate(envs):
+                expected = np.zeros(size * size, dtype=bool)
+                for r, c in env.get_valid_moves(env.current_player):
+                    expected[r * size + c] = True
+                assert (mask[i] == expected).all()
+            states, rewards, dones, info = vec_env.step(actions)
+            for i, env in enumerate(envs):
+                state, reward, done, _ = env.step(divmod(int(actions[i]), size))
+                assert reward == rewards[i] and done == dones[i], (size, i)
+                assert (state == info['terminal_state'][i]).all()
+                if done:
+                    env.reset()
+        print(f"size {size}: OK")
+
+    num_envs, num_steps = 4096, 200
+    vec_env = VecFlipTacEnv(num_envs, size=7)
+    start = time.perf_counter()
+    for _ in range(num_steps):
+        vec_env.step(random_actions(vec_env.legal_mask()))
+    elapsed = time.perf_counter() - start
+    print(f"{num_envs * num_steps / elapsed:,.0f} steps/sec ({num_envs} games, size 7)")
@@ -0,0 +1,192 @@
+import math
+import queue
+import random
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from FlipTacEnv import FlipTacEnv
+from model import build_model, fuse_for_inference, masked_argmax
+from replay import pack_states
+
+
+class ActorPool:
+    """
+    自己対戦を行う actor プロセス群と、学習側（learner）とのやり取り
+    重みは共有メモリ上の DQN に書き込み、版番号が変わったら各 actor が自分の複製へ読み込む。
+    経験は actor ごとに flush_size 手ずつビット列へ詰め、キューで learner へ送る。
+    """
+    def __init__(self, num_actors, board_size, pool_size, eps_start, eps_end, eps_decay,
+                 steps_done=0, flush_size=64, self_play_rate=0.25, use_bitboard=True, model_arch='dqn', seed=None):
+        # fork が使えるなら使う（spawn だと学習スクリプト全体が actor ごとに読み込み直される）
+        ctx = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        self.policy = build_model(model_arch, board_size, board_size).share_memory()
+        # 相手の枠は fuse_for_inference した形（BatchNorm を畳み込んだもの）で持つ
+        self.opponents = [fuse_for_inference(build_model(model_arch, board_size, board_size)).share_memory()
+                          for _ in range(pool_size)]
+        self.versions = ctx.Array('q', pool_size + 1, lock=False) # [0] は policy、[1+i] は相手の枠 i（0 は空き）
+        self.lock = ctx.Lock()
+        self.steps_done = ctx.Value('q', steps_done)
+        self.queue = ctx.Queue(maxsize=4 * num_actors)
+        self.stop = ctx.Event()
+        self.next_slot = 0
+        settings = {'board_size': board_size, 'eps_start': eps_start, 'eps_end': eps_end, 'eps_decay': eps_decay,
+                    'flush_size': flush_size, 'self_play_rate': self_play_rate, 'use_bitboard': use_bitboard,
+                    'model_arch': model_arch}
+        base_seed = random.randrange(2**31) if seed is None else seed
+        self.processes = [ctx.Process(target=_actor_main, daemon=True,
+                                      args=(base_seed + i, settings, self.policy, self.opponents, self.versions,
+                                            self.lock, self.steps_done, self.queue, self.stop))
+                          for i in range(num_actors)]
+
+    def start(self):
+        for process in self.processes:
+            process.start()
+
+    def _publish(self, shared, net, slot):
+        with self.lock:
+            for dst, src in zip(shared.state_dict().values(), net.state_dict().values()):
+                dst.copy_(src)
+            self.versions[slot] += 1
+
+    def publish_weights(self, net):
+        """actor が使う最新の方策を差し替える"""
+        self._publish(self.policy, net, 0)
+
+    def publish_opponent(self, net):
+        """対戦相手の枠に net（fuse_for_inference したもの）の複製を加える（満杯なら一番古い枠を上書きする）"""
+        slot = self.next_slot
+        self._publish(self.opponents[slot], net, slot + 1)
+        self.next_slot = (slot + 1) % len(self.opponents)
+
+    def drain(self, memory, block=False, timeout=1.0):
+        """届いている経験をすべて memory に入れ、(経験数, 終わった対局数) を返す"""
+        transitions = episodes = 0
+        while True:
+            try:
+                chunk = self.queue.get(block=block and transitions == 0 and episodes == 0, timeout=timeout)
+            except queue.Empty:
+                return transitions, episodes
+            *arrays, finished = chunk
+            if len(arrays[2]):
+                memory.push_packed_batch(*arrays)
+            transitions += len(arrays[2])
+            episodes += finished
+
+    def close(self):
+        self.stop.set()
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive(): process.terminate()
+
+
+def _actor_main(seed, settings, shared_policy, shared_opponents, versions, lock, steps_done, out_queue, stop):
+    """1つの actor: ε-greedy の方策で先手(1)を持ち、最新の自分かプールの相手と対局し続ける"""
+    torch.set_num_threads(1) # actor 同士でコアを取り合わないようにする
+    out_queue.cancel_join_thread() # 終了時に送りきれなかった経験は捨てる
+    rng = random.Random(seed)
+    size = settings['board_size']
+    env = FlipTacEnv(size=size, use_bitboard=settings['use_bitboard'])
+    # 対局には BatchNorm を畳み込んだ推論用のモデルを使う（policy は読み込むたびに畳み込み直す）
+    policy_weights = build_model(settings['model_arch'], size, size).eval()
+    policy = fuse_for_inference(policy_weights)
+    opponents = [fuse_for_inference(build_model(settings['model_arch'], size, size)) for _ in shared_opponents]
+    seen = [0] * len(versions)
+    chunk = {'states': [], 'actions': [], 'next_states': [], 'rewards': [], 'dones': []}
+    local_steps = finished = 0
+
+    def greedy(net, observation):
+        mask = env.legal_mask()
+        if not mask.any(): return None
+        with torch.no_grad():
+            q_values = net(torch.from_numpy(observation).unsqueeze(0))
+        action_idx = masked_argmax(q_values, torch.from_numpy(mask).unsqueeze(0)).item()
+        return (action_idx // size, action_idx % size)
+
+    while not stop.is_set():
+        # 対局の開始ごとに、更新された重みだけを読み込み直す
+        for slot, net in enumerate([policy_weights] + opponents):
+            if versions[slot] != seen[slot]:
+                with lock:
+                    net.load_state_dict((shared_opponents[slot - 1] if slot else shared_policy).state_dict())
+                    seen[slot] = versions[slot]
+                if not slot: fuse_for_inference(policy_weights, out=policy)
+        filled = [net for slot, net in enumerate(opponents) if seen[slot + 1]]
+        opponent = policy if not filled or rng.random() < settings['self_play_rate'] else rng.choice(filled)
+
+        observation = env.reset()
+        while True:
+            if env.current_player == 1:
+                steps = steps_done.value + local_steps
+                eps_threshold = settings['eps_end'] + (settings['eps_start'] - settings['eps_end']) * math.exp(-1. * steps / settings['eps_decay'])
+                local_steps += 1
+                if rng.random() > eps_threshold:
+                    action = greedy(policy, observation)
+                else:
+                    valid_moves = env.get_valid_moves(env.current_player)
+                    action = rng.choice(valid_moves) if valid_moves else None
+            else:
+                action = greedy(opponent, observation)
+            if action is None: break
+
+            is_ai_turn = env.current_player == 1
+            prev_observation = observation
+            observation, reward, done, _ = env.step(action)
+            if is_ai_turn:
+                chunk['states'].append(prev_observation)
+                chunk['actions'].append(action[0] * size + action[1])
+                chunk['next_states'].append(observation)
+                chunk['rewards'].append(reward)
+                chunk['dones'].append(done)
+            if done: break
+        finished += 1
+
+        if len(chunk['actions']) >= settings['flush_size']:
+            with steps_done.get_lock():
+                steps_done.value += local_steps
+            local_steps = 0
+            _send(out_queue, stop, chunk, finished)
+            finished = 0
+            for values in chunk.values():
+                values.clear()
+
+
+def _send(out_queue, stop, chunk, finished):
+    states, sides = pack_states(np.stack(chunk['states']))
+    next_states, next_sides = pack_states(np.stack(chunk['next_states']))
+    item = (states, sides, np.array(chunk['actions'], dtype=np.int16), next_states, next_sides,
+            np.array(chunk['rewards'], dtype=np.float32), np.array(chunk['dones'], dtype=bool), finished)
+    while not stop.is_set(): # learner が追いつかないときはここで待つ
+        try:
+            out_queue.put(item, timeout=0.5)
+            return
+        except queue.Full:
+            pass
+
+
+# ===============================================================
+# 計測: python actor_learner.py（actor 数ごとに learner が受け取る経験の速さを測る）
+# ===============================================================
+if __name__ == '__main__':
+    from replay import ReplayBuffer
+
+    BOARD_SIZE = 7
+    SECONDS = 10
+
+    for num_actors in sorted({1, 2, 4, mp.cpu_count()}):
+        memory = ReplayBuffer(100000, (3, BOARD_SIZE, BOARD_SIZE))
+        actors = ActorPool(num_actors, BOARD_SIZE, pool_size=4, eps_start=0.5, eps_end=0.5, eps_decay=1)
+        actors.publish_weights(build_model('dqn', BOARD_SIZE, BOARD_SIZE).eval())
+        actors.start()
+        actors.drain(memory, block=True, timeout=60) # 起動を待つ
+        start = time.perf_counter()
+        transitions = episodes = 0
+        while time.perf_counter() - start < SECONDS:
+            received, finished = actors.drain(memory, block=True)
+            transitions += received
+            episodes += finished
+        elapsed = time.perf_counter() - start
+        actors.close()
+        print(f"{num_actors:2d} actors: {transitions / elapsed:8,.0f} transitions/sec, {episodes / elapsed:6,.1f} games/sec")
@@ -0,0 +1,78 @@
+from functools import lru_cache
+
+import numpy as np
+import torch
+
+
+@lru_cache(maxsize=None)
+def dihedral_permutations(size):
+    """
+    正方形の8通りの回転・反転をマスの並べ替え表 (8, size*size) で返す（盤面サイズごとにキャッシュ）
+    変換後の盤面の k 番目のマスには、元の盤面の perms[t, k] 番目のマスが来る。
+    """
+    grid = np.arange(size * size).reshape(size, size)
+    transforms = [np.rot90(grid, k) for k in range(4)] + [np.rot90(grid.T, k) for k in range(4)]
+    return np.stack([t.reshape(-1) for t in transforms])
+
+
+class DihedralAugmenter:
+    """
+    サンプルしたバッチの経験ごとに、8通りの回転・反転から1つをランダムに選んで掛ける
+    FlipTac のルールと報酬は盤面の回転・反転で変わらないので、変換後も同じ報酬の正しい経験になる。
+    観測は state と next_state を並べて1回の gather で並べ替え、行動は逆変換の表で引く。
+    """
+    def __init__(self, size, device='cpu'):
+        perms = dihedral_permutations(size)
+        self.size = size
+        self.device = device
+        self.perms = torch.from_numpy(perms).to(device)
+        self.inverse = torch.from_numpy(np.argsort(perms, axis=1)).to(device) # 元のマス → 変換後のマス
+
+    def __call__(self, states, actions, next_states, transforms=None):
+        """states, next_states: (B, C, size, size)、actions: (B,) の盤面インデックス"""
+        batch, channels = states.shape[:2]
+        if transforms is None:
+            transforms = torch.randint(8, (batch,), device=self.device)
+        planes = torch.cat((states, next_states), dim=1).view(batch, 2 * channels, -1)
+        index = self.perms[transforms].unsqueeze(1).expand_as(planes)
+        planes = planes.gather(2, index).view(batch, 2 * channels, self.size, self.size)
+        return planes[:, :channels], self.inverse[transforms, actions], planes[:, channels:]
+
+
+# ===============================================================
+# 対称性の確認: python augment.py
+# （ランダムな対局と、それを回転・反転した対局で報酬と観測が一致するか）
+# ===============================================================
+if __name__ == '__main__':
+    import random
+    from FlipTacEnv import FlipTacEnv
+
+    rng = random.Random(0)
+    for size in (5, 7):
+        augmenter = DihedralAugmenter(size)
+        for game in range(50):
+            env = FlipTacEnv(size=size)
+            observation = env.reset()
+            states, actions, next_states, rewards = [], [], [], []
+            done = False
+            while not done:
+                action = rng.choice(env.get_valid_moves(env.current_player))
+                states.append(observation)
+                observation, reward, done, _ = env.step(action)
+                actions.append(action[0] * size + action[1])
+                next_states.append(observation)
+                rewards.append(reward)
+            states = torch.from_numpy(np.stack(states))
+            next_states = torch.from_numpy(np.stack(next_states))
+            actions = torch.tensor(actions)
+            for t in range(8):
+                transforms = torch.full((len(actions),), t)
+                aug_states, aug_actions, aug_next_states = augmenter(states, actions, next_states, transforms)
+                env = FlipTacEnv(size=size)
+                assert (torch.from_numpy(env.reset()) == aug_states[0]).all()
+                for i, action in enumerate(aug_actions.tolist()):
+                    assert (torch.from_numpy(env._get_state()) == aug_states[i]).all()
+                    observation, reward, done, _ = env.step(divmod(action, size))
+                    assert reward == rewards[i], (size, game, t, i)
+                    assert (torch.from_numpy(observation) == aug_next_states[i]).all()
+        print(f"size {size}: OK")
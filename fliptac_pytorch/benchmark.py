@@ -0,0 +1,318 @@
+import random
+import shutil
+import sys
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+import torch
+
+from FlipTacEnv import FlipTacEnv
+from model import DQN, MODEL_ARCHS, build_model, fuse_for_inference, masked_argmax, script_for_inference, soft_update
+from replay import ReplayBuffer, SumTree
+from selfplay import LockstepSelfPlay
+
+# ===============================================================
+# 設定
+# ===============================================================
+BOARD_SIZE = 7
+NUM_STEPS = 20000 # 計測するstep数
+BATCH_SIZE = 256
+REPLAY_CAPACITIES = (10000, 1000000)
+LEGACY_REPLAY_CAPACITIES = (10000, 100000)
+SUMTREE_CAPACITY = 1000000
+SELFPLAY_GAMES = (1, 16, 64, 256)
+REPLAY_SAVE_CAPACITY = 1000000
+REPLAY_SAVE_DIR = 'benchmark_replay_memory'
+MODEL_BATCH_SIZES = (1, 32, 256)
+BENCH_TORCH_COMPILE = False # fused の計測に torch.compile の版も加える（バッチサイズごとに数十秒コンパイルする）
+SELFPLAY_MOVES = 4000 # 計測する手数（全ゲームの合計）
+
+
+class LegacyFlipTacEnv(FlipTacEnv):
+    """
+    比較用: 報酬計算を1手ごとに作り直していた頃の step
+    （全マス走査の有効手生成、盤面のコピーと self の書き換えを含む）
+    """
+    def get_valid_moves(self, player):
+        moves = []
+        for r in range(self.size):
+            for c in range(self.size):
+                if self.is_valid_move(player, r, c):
+                    moves.append((r, c))
+        return moves
+    def _calculate_potential(self, player):
+        my_moves = len(self.get_valid_moves(player))
+        opponent_moves = len(self.get_valid_moves(-player))
+        return my_moves - (opponent_moves * 1.5)
+    def step(self, action):
+        row, col = action
+        player = self.current_player
+        potential_before = self._calculate_potential(player)
+        if not self.is_valid_move(player, row, col):
+            return self._get_state(), -20.0, True, {}
+        temp_board = np.copy(self.board)
+        temp_last_move = self.last_move.copy()
+        temp_board[row, col] = player
+        temp_last_move[player] = (row, col)
+        original_board, original_last_move = self.board, self.last_move
+        self.board, self.last_move = temp_board, temp_last_move
+        my_next_moves = self.get_valid_moves(player)
+        self.board, self.last_move = original_board, original_last_move
+        self.board[row, col] = player
+        self.last_move[player] = (row, col)
+        self.current_player *= -1
+        opponent = self.current_player
+        potential_after = self._calculate_potential(player)
+        reward = 0.0
+        if len(my_next_moves) <= 2:
+            reward -= 0.5
+        corners = [(0, 0), (0, self.size - 1), (self.size - 1, 0), (self.size - 1, self.size - 1)]
+        if action in corners: reward -= 0.25
+        opponent_last_move = self.last_move[opponent]
+        if opponent_last_move:
+            opp_r, opp_c = opponent_last_move
+            dist = abs(row - opp_r) + abs(col - opp_c)
+            if dist <= 4:
+                reward += (1 / (dist + 3)) * 0.2
+        opponent_valid_moves = self.get_valid_moves(opponent)
+        done = False
+        base_reward = 0.0
+        if not opponent_valid_moves:
+            done, base_reward = True, 1.5
+        elif not my_next_moves:
+            done, base_reward = True, -2.0
+        reward += base_reward
+        shaping_reward = (self.gamma * potential_after) - potential_before
+        reward += self.shaping_factor * shaping_reward
+        reward -= 0.01
+        return self._get_state(), reward, done, {}
+
+
+def record_games(num_steps, size, seed=0):
+    """ランダム対局の手順を記録しておき、全ての環境に同じ手を打たせる"""
+    rng = random.Random(seed)
+    env = FlipTacEnv(size=size, use_bitboard=True)
+    games, actions = [], []
+    env.reset()
+    for _ in range(num_steps):
+        action = rng.choice(env.get_valid_moves(env.current_player))
+        actions.append(action)
+        _, _, done, _ = env.step(action)
+        if done:
+            games.append(actions)
+            actions = []
+            env.reset()
+    return games
+
+
+def bench_env_step(env, games):
+    rewards = []
+    start = time.perf_counter()
+    for actions in games:
+        env.reset()
+        for action in actions:
+            rewards.append(env.step(action)[1])
+    elapsed = time.perf_counter() - start
+    return sum(len(actions) for actions in games) / elapsed, rewards
+
+
+def report_env_step():
+    games = record_games(NUM_STEPS, BOARD_SIZE)
+    print(f"--- FlipTacEnv.step ({BOARD_SIZE}x{BOARD_SIZE}, {sum(map(len, games))} steps) ---")
+    baseline, expected = bench_env_step(LegacyFlipTacEnv(size=BOARD_SIZE), games)
+    print(f"before            : {baseline:10,.0f} steps/sec")
+    for name, env in (("after (array)", FlipTacEnv(size=BOARD_SIZE)),
+                      ("after (bitboard)", FlipTacEnv(size=BOARD_SIZE, use_bitboard=True))):
+        steps_per_sec, rewards = bench_env_step(env, games)
+        assert rewards == expected, "報酬が一致しません"
+        print(f"{name:<18}: {steps_per_sec:10,.0f} steps/sec (x{steps_per_sec / baseline:.1f})")
+
+
+def time_per_call(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def report_replay_sample():
+    print(f"--- Replay Memory sample (batch {BATCH_SIZE}, {BOARD_SIZE}x{BOARD_SIZE}) ---")
+    shape = (3, BOARD_SIZE, BOARD_SIZE)
+    state = np.zeros(shape, dtype=np.float32)
+    for capacity in REPLAY_CAPACITIES:
+        memory = ReplayBuffer(capacity, shape)
+        for i in range(capacity):
+            memory.push(state, i % (BOARD_SIZE * BOARD_SIZE), state, 0.0, i % 50 == 0)
+        seconds = time_per_call(lambda: memory.sample(BATCH_SIZE), 200)
+        print(f"ReplayBuffer  capacity {capacity:>9,}: {seconds * 1e3:7.3f} ms/batch, "
+              f"{memory.nbytes() / capacity:.0f} bytes/transition ({memory.nbytes() / 2**20:,.0f} MiB)")
+
+    # 比較用: deque に namedtuple とテンソルを積んでいた頃の sample と torch.cat
+    Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
+    for capacity in LEGACY_REPLAY_CAPACITIES:
+        memory = deque([Transition(torch.zeros(1, *shape), (0, 0), torch.zeros(1, *shape), torch.zeros(1))
+                        for _ in range(capacity)], maxlen=capacity)
+        def legacy_sample():
+            batch = Transition(*zip(*random.sample(memory, BATCH_SIZE)))
+            torch.tensor(tuple(map(lambda s: s is not None, batch.next_state)), dtype=torch.bool)
+            torch.cat([s for s in batch.next_state if s is not None]), torch.cat(batch.state), torch.cat(batch.reward)
+            torch.tensor([a[0] * BOARD_SIZE + a[1] for a in batch.action])
+        seconds = time_per_call(legacy_sample, 50)
+        print(f"deque (before) capacity {capacity:>8,}: {seconds * 1e3:7.3f} ms/batch, "
+              f"{2 * 4 * np.prod(shape)} bytes/transition of state tensors alone")
+
+
+def report_sumtree():
+    print(f"--- SumTree (capacity {SUMTREE_CAPACITY:,}, batch {BATCH_SIZE}) ---")
+    rng = np.random.default_rng(0)
+    tree = SumTree(SUMTREE_CAPACITY)
+    start = time.perf_counter()
+    tree.update(np.arange(SUMTREE_CAPACITY), rng.random(SUMTREE_CAPACITY))
+    print(f"fill all leaves      : {(time.perf_counter() - start) * 1e3:7.1f} ms")
+    indices = rng.integers(0, SUMTREE_CAPACITY, size=BATCH_SIZE)
+    priorities = rng.random(BATCH_SIZE)
+    seconds = time_per_call(lambda: tree.update(indices, priorities), 500)
+    print(f"update (batch)       : {seconds * 1e6:7.1f} us/batch")
+    seconds = time_per_call(lambda: tree.update_one(12345, 0.5), 20000)
+    print(f"update_one           : {seconds * 1e6:7.1f} us/call")
+    values = rng.random(BATCH_SIZE) * tree.total()
+    seconds = time_per_call(lambda: tree.find(values), 500)
+    print(f"find (batch)         : {seconds * 1e6:7.1f} us/batch")
+
+
+def report_selfplay():
+    print(f"--- self-play inference ({BOARD_SIZE}x{BOARD_SIZE}, policy + 3 opponents, greedy) ---")
+    torch.set_grad_enabled(False)
+    policy = DQN(BOARD_SIZE, BOARD_SIZE).eval()
+    pool = [DQN(BOARD_SIZE, BOARD_SIZE).eval() for _ in range(3)]
+    rng = random.Random(0)
+
+    # 比較用: 1局ずつ、手番ごとにバッチサイズ1で forward していた頃のループ
+    env = FlipTacEnv(size=BOARD_SIZE, use_bitboard=True)
+    moves = 0
+    start = time.perf_counter()
+    while moves < SELFPLAY_MOVES:
+        opponent = rng.choice(pool)
+        observation = env.reset()
+        done = False
+        while not done:
+            net = policy if env.current_player == 1 else opponent
+            q_values = net(torch.from_numpy(observation).unsqueeze(0))
+            mask = torch.from_numpy(env.legal_mask()).unsqueeze(0)
+            action_idx = masked_argmax(q_values, mask).item()
+            observation, _, done, _ = env.step((action_idx // BOARD_SIZE, action_idx % BOARD_SIZE))
+            moves += 1
+    baseline = moves / (time.perf_counter() - start)
+    print(f"one game at a time  : {baseline:10,.0f} moves/sec")
+
+    for num_games in SELFPLAY_GAMES:
+        selfplay = LockstepSelfPlay(num_games, BOARD_SIZE, policy, lambda: rng.choice(pool), seed=0)
+        selfplay.step(0.0)
+        ticks = max(SELFPLAY_MOVES // num_games, 20)
+        start = time.perf_counter()
+        for _ in range(ticks):
+            selfplay.step(0.0)
+        moves_per_sec = ticks * num_games / (time.perf_counter() - start)
+        print(f"lockstep {num_games:4d} games : {moves_per_sec:10,.0f} moves/sec (x{moves_per_sec / baseline:.1f})")
+    torch.set_grad_enabled(True)
+
+
+def report_soft_update():
+    tau = 0.005
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        print(f"--- soft target update (DQN {BOARD_SIZE}x{BOARD_SIZE}, {device}) ---")
+        policy_net = DQN(BOARD_SIZE, BOARD_SIZE).to(device)
+        target_net = DQN(BOARD_SIZE, BOARD_SIZE).to(device)
+        sync = torch.cuda.synchronize if device == 'cuda' else (lambda: None)
+
+        # 比較用: state_dict を作り直して load_state_dict していた頃の更新
+        def legacy_update():
+            target_net_state_dict = target_net.state_dict()
+            policy_net_state_dict = policy_net.state_dict()
+            for key in policy_net_state_dict:
+                target_net_state_dict[key] = policy_net_state_dict[key]*tau + target_net_state_dict[key]*(1-tau)
+            target_net.load_state_dict(target_net_state_dict)
+            sync()
+        def fused_update():
+            soft_update(target_net, policy_net, tau)
+            sync()
+        baseline = time_per_call(legacy_update, 200)
+        seconds = time_per_call(fused_update, 200)
+        print(f"state_dict (before): {baseline * 1e3:7.3f} ms/update")
+        print(f"soft_update        : {seconds * 1e3:7.3f} ms/update (x{baseline / seconds:.1f})")
+
+
+def report_replay_save():
+    print(f"--- Replay Memory save / load (capacity {REPLAY_SAVE_CAPACITY:,}, {BOARD_SIZE}x{BOARD_SIZE}) ---")
+    shape = (3, BOARD_SIZE, BOARD_SIZE)
+    rng = np.random.default_rng(0)
+    memory = ReplayBuffer(REPLAY_SAVE_CAPACITY, shape)
+    nbytes = memory.states.shape[1]
+    for start in range(0, REPLAY_SAVE_CAPACITY, 65536):
+        n = min(65536, REPLAY_SAVE_CAPACITY - start)
+        stones = rng.integers(0, 256, (n, nbytes), dtype=np.uint8)
+        memory.push_packed_batch(stones, np.ones(n, np.int8), rng.integers(0, BOARD_SIZE ** 2, n),
+                                 stones, -np.ones(n, np.int8), rng.random(n, dtype=np.float32), rng.random(n) < 0.05)
+    seconds = time_per_call(memory.snapshot, 5)
+    print(f"snapshot (copy)     : {seconds * 1e3:7.3f} ms")
+    start = time.perf_counter()
+    memory.save(REPLAY_SAVE_DIR)
+    print(f"save                : {time.perf_counter() - start:7.3f} s ({memory.nbytes() / 2**20:,.0f} MiB)")
+    loaded = ReplayBuffer(REPLAY_SAVE_CAPACITY, shape)
+    start = time.perf_counter()
+    loaded.load(REPLAY_SAVE_DIR)
+    print(f"load (mmap)         : {(time.perf_counter() - start) * 1e3:7.3f} ms")
+    start = time.perf_counter()
+    loaded.sample(BATCH_SIZE)
+    print(f"first sample        : {(time.perf_counter() - start) * 1e3:7.3f} ms")
+    seconds = time_per_call(lambda: loaded.sample(BATCH_SIZE), 200)
+    print(f"sample              : {seconds * 1e3:7.3f} ms/batch")
+    del loaded
+    shutil.rmtree(REPLAY_SAVE_DIR)
+
+
+def report_models():
+    print(f"--- model forward latency ({BOARD_SIZE}x{BOARD_SIZE}, eval, CPU, {torch.get_num_threads()} threads) ---")
+    with torch.no_grad():
+        for arch in MODEL_ARCHS:
+            model = build_model(arch, BOARD_SIZE, BOARD_SIZE).eval()
+            params = sum(p.numel() for p in model.parameters())
+            latencies = []
+            for batch_size in MODEL_BATCH_SIZES:
+                x = torch.randn(batch_size, 3, BOARD_SIZE, BOARD_SIZE)
+                latencies.append(time_per_call(lambda: model(x), 200 if batch_size < 256 else 50))
+            print(f"{arch:<5} {params:>10,} params | " + ", ".join(
+                f"batch {b}: {t * 1e3:6.3f} ms" for b, t in zip(MODEL_BATCH_SIZES, latencies)))
+
+
+def report_fused():
+    print(f"--- BatchNorm folding ({BOARD_SIZE}x{BOARD_SIZE}, eval, CPU, {torch.get_num_threads()} threads) ---")
+    with torch.no_grad():
+        for arch in MODEL_ARCHS:
+            model = build_model(arch, BOARD_SIZE, BOARD_SIZE).eval()
+            variants = [('eval', model), ('fused', fuse_for_inference(model)), ('scripted', script_for_inference(model))]
+            if BENCH_TORCH_COMPILE:
+                variants.append(('compiled', torch.compile(fuse_for_inference(model))))
+            baseline = []
+            for name, net in variants:
+                latencies = []
+                for batch_size in MODEL_BATCH_SIZES:
+                    x = torch.randn(batch_size, 3, BOARD_SIZE, BOARD_SIZE)
+                    assert torch.allclose(net(x), model(x), rtol=1e-4, atol=1e-5), "Q値が一致しません"
+                    latencies.append(time_per_call(lambda: net(x), 200 if batch_size < 256 else 50))
+                baseline = baseline or latencies
+                print(f"{arch:<5} {name:<9}| " + ", ".join(
+                    f"batch {b}: {t * 1e3:6.3f} ms (x{t0 / t:.2f})" for b, t, t0 in zip(MODEL_BATCH_SIZES, latencies, baseline)))
+
+
+SECTIONS = {'env': report_env_step, 'replay': report_replay_sample, 'sumtree': report_sumtree,
+            'selfplay': report_selfplay, 'softupdate': report_soft_update, 'replaysave': report_replay_save,
+            'models': report_models, 'fused': report_fused}
+
+# python benchmark.py [env|replay|sumtree|selfplay|softupdate|replaysave|models|fused ...]（省略時はすべて）
+if __name__ == '__main__':
+    for name in sys.argv[1:] or SECTIONS:
+        SECTIONS[name]()
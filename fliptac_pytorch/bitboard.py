@@ -0,0 +1,123 @@
+from functools import lru_cache
+
+
+class BitboardTables:
+    """
+    盤面サイズごとに事前計算したビットマスク表
+    マス(r, c)は r * size + c 番目のビットに対応する。
+    """
+    def __init__(self, size):
+        self.size = size
+        n = size * size
+        self.full = (1 << n) - 1
+        self.edge = 0
+        self.adjacent = [0] * n # 周囲8マスのマスク
+        self.jumps = [()] * n   # 上下左右の (飛び越えるマスのビット, 着地マスのビット)
+        for r in range(size):
+            for c in range(size):
+                i = r * size + c
+                if r == 0 or r == size - 1 or c == 0 or c == size - 1:
+                    self.edge |= 1 << i
+                adjacent = 0
+                for dr in (-1, 0, 1):
+                    for dc in (-1, 0, 1):
+                        rr, cc = r + dr, c + dc
+                        if (dr or dc) and 0 <= rr < size and 0 <= cc < size:
+                            adjacent |= 1 << (rr * size + cc)
+                self.adjacent[i] = adjacent
+                jumps = []
+                for dr, dc in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+                    rr, cc = r + 2 * dr, c + 2 * dc
+                    if 0 <= rr < size and 0 <= cc < size:
+                        jumps.append((1 << ((r + dr) * size + c + dc), 1 << (rr * size + cc)))
+                self.jumps[i] = tuple(jumps)
+
+
+@lru_cache(maxsize=None)
+def get_tables(size):
+    return BitboardTables(size)
+
+
+def mask_to_moves(mask, size):
+    """マスクを (row, col) のリストに変換する（盤面の走査順と同じ並び）"""
+    moves = []
+    while mask:
+        low = mask & -mask
+        moves.append(divmod(low.bit_length() - 1, size))
+        mask ^= low
+    return moves
+
+
+def popcount(mask):
+    return bin(mask).count('1')
+
+
+class Bitboard:
+    """
+    各プレイヤーの石と空きマスを整数のビットマスクで保持する盤面
+    有効手の集合は数回のマスク演算で求まる。
+    """
+    def __init__(self, size):
+        self.size = size
+        self.tables = get_tables(size)
+        self.reset()
+
+    def reset(self):
+        self.stones = {1: 0, -1: 0}
+        self.empty = self.tables.full
+        self.last = {1: None, -1: None}
+
+    def place(self, player, index):
+        bit = 1 << index
+        self.stones[player] |= bit
+        self.empty &= ~bit
+        self.last[player] = index
+
+    def remove(self, player, index, previous_last):
+        bit = 1 << index
+        self.stones[player] &= ~bit
+        self.empty |= bit
+        self.last[player] = previous_last
+
+    def valid_mask(self, player):
+        last = self.last[player]
+        if last is None: return self.tables.edge & self.empty
+        mask = self.tables.adjacent[last]
+        opponent_stones = self.stones[-player]
+        for mid, dest in self.tables.jumps[last]:
+            if opponent_stones & mid:
+                mask |= dest
+        return mask & self.empty
+
+    def count_valid_moves(self, player):
+        return popcount(self.valid_mask(player))
+
+
+# ===============================================================
+# 配列版との一致確認: python bitboard.py
+# ===============================================================
+if __name__ == '__main__':
+    import random
+    from FlipTacEnv import FlipTacEnv
+
+    for size in (5, 7):
+        for game in range(300):
+            rng_seed = size * 1000 + game
+            random.seed(rng_seed)
+            reference = FlipTacEnv(size=size, use_bitboard=False)
+            bitboard = FlipTacEnv(size=size, use_bitboard=True)
+            done = False
+            while not done:
+                for player in (1, -1):
+                    assert reference.get_valid_moves(player) == bitboard.get_valid_moves(player), (size, rng_seed)
+                    for r in range(size):
+                        for c in range(size):
+                            assert reference.is_valid_move(player, r, c) == bitboard.is_valid_move(player, r, c)
+                moves = reference.get_valid_moves(reference.current_player)
+                if not moves: break
+                # 時々あえて無効手も打って、ペナルティの一致も確認する
+                action = random.choice(moves) if random.random() > 0.02 else (random.randrange(size), random.randrange(size))
+                ref_state, ref_reward, done, _ = reference.step(action)
+                bb_state, bb_reward, bb_done, _ = bitboard.step(action)
+                assert (ref_state == bb_state).all() and ref_reward == bb_reward and done == bb_done, (size, rng_seed)
+        print(f"size {size}: OK")
@@ -0,0 +1,109 @@
+import json
+import os
+import queue
+import re
+import threading
+
+import torch
+
+
+def to_cpu(obj):
+    """state_dict などに含まれるテンソルを CPU 上の複製に置き換える（学習を続けても書き出す内容が変わらない）"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """一時ファイルに書き切ってから置き換えるので、途中まで書かれたファイルが path に現れることはない"""
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_write_json(obj, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def load_pool_index(opponent_dir):
+    """
+    対戦相手プールのファイル名を古い順に返す
+    index.json があればそれを使い、なければ（index.json を書く前のプールから）ファイル名の番号順に並べる。
+    """
+    index_path = os.path.join(opponent_dir, 'index.json')
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            files = json.load(f)['files']
+    elif os.path.exists(opponent_dir):
+        files = sorted((f for f in os.listdir(opponent_dir) if re.fullmatch(r'.*_(\d+)\.pth', f)),
+                       key=lambda f: int(re.search(r'_(\d+)\.pth', f).group(1)))
+    else:
+        files = []
+    return [f for f in files if os.path.exists(os.path.join(opponent_dir, f))]
+
+
+class CheckpointWriter:
+    """
+    チェックポイントと対戦相手プールの書き出しを受け持つバックグラウンドのスレッド
+    呼び出し側は CPU に写したテンソルを渡してすぐ学習に戻り、書き込みはこのスレッドが順に行う。
+    プールのファイルは index.json に古い順に記録し、pool_size を超えたら一番古いものを消す。
+    """
+    def __init__(self, opponent_dir, pool_size):
+        self.opponent_dir = opponent_dir
+        self.pool_size = pool_size
+        self.pool_files = load_pool_index(opponent_dir)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, obj, path):
+        """obj（to_cpu 済みのもの）を path に書き出す"""
+        self.queue.put((atomic_save, (obj, path)))
+
+    def add_opponent(self, state_dict, name):
+        """対戦相手プールに state_dict（to_cpu 済みのもの）を name で加える"""
+        self.queue.put((self._add_opponent, (state_dict, name)))
+
+    def run(self, fn, *args):
+        """fn(*args) をほかの書き出しと同じスレッドで順に行う（Replay Memory の保存など）"""
+        self.queue.put((fn, args))
+
+    def flush(self):
+        """依頼済みの書き出しがすべて終わるまで待つ"""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is None: break
+            fn, args = task
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"Warning: Could not write checkpoint. Error: {e}")
+            finally:
+                self.queue.task_done()
+
+    def _add_opponent(self, state_dict, name):
+        os.makedirs(self.opponent_dir, exist_ok=True)
+        atomic_save({'policy_net_state_dict': state_dict}, os.path.join(self.opponent_dir, name))
+        self.pool_files = [f for f in self.pool_files if f != name] + [name]
+        evicted = self.pool_files[:max(len(self.pool_files) - self.pool_size, 0)]
+        self.pool_files = self.pool_files[len(evicted):]
+        # 先に index.json を書き換えてから消すので、index.json にあるファイルは必ず読める
+        atomic_write_json({'files': self.pool_files}, os.path.join(self.opponent_dir, 'index.json'))
+        for f in evicted:
+            path = os.path.join(self.opponent_dir, f)
+            if os.path.exists(path): os.remove(path)
@@ -1,42 +1,247 @@
+import importlib.util
+import inspect
+import os
+import sys
+import time
+
+import numpy as np
 import torch
-from model import DQN  # model.py からDQNクラスをインポート
+from model import MaskedPolicy, build_model, fuse_for_inference  # model.py からモデルを作る関数をインポート
+from VecFlipTacEnv import VecFlipTacEnv
 
 # --- 設定 ---
 BOARD_SIZE = 7
 PATH_TO_PTH_FILE = "fliptac_dqn_final.pth"  # あなたの学習済みモデルのパス
 OUTPUT_ONNX_FILE = "fliptac_model.onnx"
+EXPORT_QUANTIZED = False # INT8 と FP16 の版も書き出し、FP32 と大きさ・速さ・選ぶ手を比べる（onnx と onnxruntime が必要）
+INT8_MODE = 'static' # 'static'（自己対戦の局面で活性化の範囲を較正する）か 'dynamic'
+CALIBRATION_POSITIONS = 1000 # 較正に使う局面の数
+EVAL_POSITIONS = 4000 # 選ぶ手の一致率を調べる局面の数（較正とは別の対局から取る）
+LATENCY_BATCH_SIZES = (1, 64)
+AGREEMENT_THRESHOLD = 0.99 # これ以上 FP32 と同じ手を選ぶ版のうち、一番小さいものを勧める
+# 有効手での最善手の選択までをグラフに含めた版（*.masked.onnx）も書き出す。出力は 'action' と、無効手を -inf にした 'output'
+# None: 書き出さない / 'mask': 入力に有効手マスク 'mask' (B, size*size) の bool を受け取る
+# 'last_move': 入力に手番のプレイヤーが最後に置いたマスだけ 1 の 'last_move' (B, 1, size, size) を受け取り、有効手はグラフの中で求める
+EXPORT_MASKED = None
+
+
+def missing_modules(*names):
+    """インストールされていないモジュールの名前を返す（量子化・確認には onnx / onnxruntime が要る）"""
+    return [name for name in names if importlib.util.find_spec(name) is None]
+
+
+def onnx_export(model, args, path, **kwargs):
+    """torch.onnx.export を呼ぶ。external_data を受け取る版の torch なら、重みも1つの .onnx に入れるよう指定する"""
+    if 'external_data' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['external_data'] = False
+    torch.onnx.export(model, args, path, **kwargs)
+
+
+def collect_positions(session, size, num_positions, num_games=64, epsilon=0.25, seed=0):
+    """
+    FP32 のモデル同士（ε-greedy）で自己対戦し、出てきた局面と有効手マスクを集める
+    戻り値: (states (N, 3, size, size), masks (N, size*size), last_moves (N, 1, size, size))
+    """
+    rng = np.random.default_rng(seed)
+    input_name = session.get_inputs()[0].name
+    env = VecFlipTacEnv(num_games, size=size)
+    state = env.reset()
+    states, masks, last_moves = [], [], []
+    while len(states) * num_games < num_positions:
+        mask = env.legal_mask()
+        states.append(state)
+        masks.append(mask.copy())
+        last_moves.append(env.last_move_planes())
+        q_values = session.run(None, {input_name: state})[0]
+        actions = np.where(mask, q_values, -np.inf).argmax(axis=1)
+        explore = rng.random(num_games) < epsilon
+        actions[explore] = (rng.random(mask.shape) * mask).argmax(axis=1)[explore]
+        state = env.step(actions)[0]
+    return tuple(np.concatenate(arrays)[:num_positions] for arrays in (states, masks, last_moves))
+
+
+def export_int8(src_path, dst_path, calibration_states, mode):
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+    import onnx
+
+    if mode == 'dynamic':
+        quantize_dynamic(src_path, dst_path, weight_type=QuantType.QUInt8)
+        return
+
+    class PositionReader(CalibrationDataReader):
+        def __init__(self, input_name, states, batch_size=64):
+            self.batches = iter([{input_name: states[i:i + batch_size]} for i in range(0, len(states), batch_size)])
+        def get_next(self):
+            return next(self.batches, None)
+
+    model = onnx.load(src_path)
+    opset = max(o.version for o in model.opset_import if o.domain in ('', 'ai.onnx'))
+    input_name = model.graph.input[0].name
+    preprocessed_path = dst_path + '.pre.onnx'
+    quant_pre_process(src_path, preprocessed_path)
+    # 出力層（Q値）は FP32 のまま残す。有効手どうしのQ値の差は小さいので、ここを8bitにすると選ぶ手が大きく変わる
+    output_node = onnx.load(preprocessed_path).graph.node[-1].name
+    try:
+        quantize_static(preprocessed_path, dst_path, PositionReader(input_name, calibration_states),
+                        quant_format=QuantFormat.QDQ, per_channel=opset >= 13,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        nodes_to_exclude=[output_node])
+    finally:
+        os.remove(preprocessed_path)
+
+
+def export_fp16(src_path, dst_path):
+    """重みと計算を FP16 にする。入出力は FP32 のままなので、呼び出し側はそのまま使える"""
+    from onnxruntime.transformers.float16 import convert_float_to_float16
+    import onnx
+
+    onnx.save(convert_float_to_float16(onnx.load(src_path), keep_io_types=True), dst_path)
+
+
+def compare_models(paths, states, masks):
+    """各モデルのファイルサイズ、ORT (CPU) の推論時間、FP32 と選ぶ手（有効手の最大Q値）の一致率を表示する"""
+    import onnxruntime as ort
+
+    reference = None
+    results = []
+    print(f"{'model':<28} {'size':>9} " + " ".join(f"{'batch ' + str(b):>11}" for b in LATENCY_BATCH_SIZES) + "  top-1 agreement")
+    for path in paths:
+        session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+        input_name = session.get_inputs()[0].name
+        q_values = np.concatenate([session.run(None, {input_name: states[i:i + 256]})[0] for i in range(0, len(states), 256)])
+        actions = np.where(masks, q_values, -np.inf).argmax(axis=1)
+        if reference is None: reference = actions
+        latencies = []
+        for batch_size in LATENCY_BATCH_SIZES:
+            batch = {input_name: states[:batch_size]}
+            session.run(None, batch)
+            repeat = 200
+            start = time.perf_counter()
+            for _ in range(repeat):
+                session.run(None, batch)
+            latencies.append((time.perf_counter() - start) / repeat)
+        agreement = (actions == reference).mean()
+        results.append((os.path.getsize(path), path, agreement))
+        print(f"{os.path.basename(path):<28} {os.path.getsize(path) / 2**20:7.2f}MB "
+              + " ".join(f"{t * 1e3:9.3f}ms" for t in latencies)
+              + f"  {agreement:8.2%}")
+    _, best, _ = min(r for r in results if r[2] >= AGREEMENT_THRESHOLD)
+    print(f"選ぶ手が {AGREEMENT_THRESHOLD:.0%} 以上一致する中で一番小さいモデル: {os.path.basename(best)}")
+
+
+def export_quantized(fp32_path, size):
+    import onnxruntime as ort
+
+    session = ort.InferenceSession(fp32_path, providers=['CPUExecutionProvider'])
+    calibration_states, _, _ = collect_positions(session, size, CALIBRATION_POSITIONS, seed=0)
+    eval_states, eval_masks, _ = collect_positions(session, size, EVAL_POSITIONS, seed=1)
+    stem = os.path.splitext(fp32_path)[0]
+    int8_path, fp16_path = f"{stem}.int8.onnx", f"{stem}.fp16.onnx"
+    export_int8(fp32_path, int8_path, calibration_states, INT8_MODE)
+    export_fp16(fp32_path, fp16_path)
+    print(f"{size}x{size}: {INT8_MODE} INT8 と FP16 の版を書き出しました（一致率は自己対戦の {len(eval_states)} 局面）")
+    compare_models([fp32_path, int8_path, fp16_path], eval_states, eval_masks)
+
+
+def export_masked(model, fp32_path, size, mode, dynamic_axes):
+    """
+    model に有効手での最善手の選択を付けて *.masked.onnx に書き出し、
+    自己対戦の局面で FP32 のモデルのQ値から選んだ手・有効手と一致するかを確かめる
+    """
+    masked_path = os.path.splitext(fp32_path)[0] + '.masked.onnx'
+    derive_mask = mode == 'last_move'
+    # last_move は入力と、mask は出力と同じ軸を可変にする
+    if derive_mask:
+        dummy_mask = torch.zeros(1, 1, size, size)
+        mask_axes = dynamic_axes['input']
+    else:
+        dummy_mask = torch.ones(1, size * size, dtype=torch.bool)
+        mask_axes = dynamic_axes['output']
+    onnx_export(MaskedPolicy(model, derive_mask=derive_mask),
+                (torch.zeros(1, 3, size, size), dummy_mask),
+                masked_path,
+                opset_version=11,
+                input_names=['input', mode],
+                output_names=['action', 'output'],
+                dynamic_axes={'input': dynamic_axes['input'], mode: mask_axes,
+                              'action': {0: 'batch_size'}, 'output': dynamic_axes['output']})
+    if missing_modules('onnxruntime'):
+        print(f"'{masked_path}' を書き出しました。onnxruntime がないため FP32 との比較は行いません（pip install onnxruntime）。")
+        return
+    import onnxruntime as ort
+
+    reference = ort.InferenceSession(fp32_path, providers=['CPUExecutionProvider'])
+    states, masks, last_moves = collect_positions(reference, size, EVAL_POSITIONS, seed=1)
+    q_values = reference.run(None, {'input': states})[0]
+    expected = np.where(masks, q_values, -np.inf).argmax(axis=1)
+    session = ort.InferenceSession(masked_path, providers=['CPUExecutionProvider'])
+    actions, masked_q = session.run(None, {'input': states, mode: last_moves if derive_mask else masks})
+    assert (np.isfinite(masked_q) == masks).all(), "有効手が環境と一致しません"
+    print(f"'{masked_path}' を書き出しました（入力 'input', '{mode}'）。"
+          f"自己対戦の {len(states)} 局面で FP32 と選ぶ手の一致率: {(actions == expected).mean():.2%}")
+
 
 # --- 実行 ---
+# python export_onnx.py            : PATH_TO_PTH_FILE を書き出す（EXPORT_QUANTIZED なら INT8 / FP16 の版も）
+# python export_onnx.py model.onnx : 書き出し済みの FP32 モデルから INT8 / FP16 の版だけを作る
 if __name__ == '__main__':
-    # 1. モデルのインスタンスを作成
-    device = torch.device("cpu")
-    model = DQN(BOARD_SIZE, BOARD_SIZE).to(device)
+    if len(sys.argv) > 1:
+        if missing_modules('onnx', 'onnxruntime'):
+            sys.exit("INT8 / FP16 の版を作るには onnx と onnxruntime が必要です: pip install onnx onnxruntime")
+        import onnx
+        OUTPUT_ONNX_FILE = sys.argv[1]
+        dims = onnx.load(OUTPUT_ONNX_FILE).graph.input[0].type.tensor_type.shape.dim
+        if dims[2].dim_value: BOARD_SIZE = dims[2].dim_value # 盤面サイズが固定のモデルならそれに合わせる
+        export_quantized(OUTPUT_ONNX_FILE, BOARD_SIZE)
+        sys.exit()
 
-    # 2. 学習済みチェックポイントを読み込む
+    # 1. 学習済みチェックポイントを読み込み、同じ種類のモデルを作成
+    device = torch.device("cpu")
     checkpoint = torch.load(PATH_TO_PTH_FILE, map_location=device)
+    model_arch = checkpoint.get('model_arch', 'dqn')
+    model = build_model(model_arch, BOARD_SIZE, BOARD_SIZE).to(device)
 
+    # 2. 重みを読み込む
     # ▼▼▼ ここからが修正箇所 ▼▼▼
     # 新しい形式のチェックポイントから、モデルの重みデータを取り出す
     # 'policy_net_state_dict' というキーを指定する
     model.load_state_dict(checkpoint['policy_net_state_dict'])
     # ▲▲▲ 修正ここまで ▲▲▲
-    
+
     model.eval() # 推論モードに設定
+    # BatchNorm を畳み込みの重みに畳み込んでから書き出す（グラフに BatchNormalization が残らない）
+    model = fuse_for_inference(model)
 
     # 3. ONNXエクスポートのためのダミー入力データを作成
     dummy_input = torch.randn(1, 3, BOARD_SIZE, BOARD_SIZE, device=device)
 
     # 4. ONNX形式にエクスポート
-    torch.onnx.export(model,
-                      dummy_input,
-                      OUTPUT_ONNX_FILE,
-                      export_params=True,
-                      opset_version=11,
-                      do_constant_folding=True,
-                      input_names=['input'],
-                      output_names=['output'],
-                      dynamic_axes={'input': {0: 'batch_size'},
-                                    'output': {0: 'batch_size'}})
+    # 全畳み込みのモデルは盤面の縦横も可変にして、1つのファイルでどのサイズにも使えるようにする
+    if model_arch == 'conv':
+        dynamic_axes = {'input': {0: 'batch_size', 2: 'height', 3: 'width'}, 'output': {0: 'batch_size', 1: 'cells'}}
+    else:
+        dynamic_axes = {'input': {0: 'batch_size'}, 'output': {0: 'batch_size'}}
+    onnx_export(model,
+                dummy_input,
+                OUTPUT_ONNX_FILE,
+                export_params=True,
+                opset_version=11,
+                do_constant_folding=True,
+                input_names=['input'],
+                output_names=['output'],
+                dynamic_axes=dynamic_axes)
 
     print(f"モデルが '{OUTPUT_ONNX_FILE}' として正常にエクスポートされました。")
 
+    # 4'. 有効手での最善手の選択までを含めた版を書き出す
+    if EXPORT_MASKED:
+        export_masked(model, OUTPUT_ONNX_FILE, BOARD_SIZE, EXPORT_MASKED, dynamic_axes)
+
+    # 5. 量子化した版を書き出して比べる
+    if EXPORT_QUANTIZED:
+        missing = missing_modules('onnx', 'onnxruntime')
+        if missing:
+            print(f"{', '.join(missing)} がないため INT8 / FP16 の版は書き出しません（pip install onnx onnxruntime）。")
+        else:
+            export_quantized(OUTPUT_ONNX_FILE, BOARD_SIZE)
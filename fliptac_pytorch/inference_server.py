@@ -0,0 +1,294 @@
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from model import LegalMask, build_model
+from mcts import OnnxEvaluator, TorchEvaluator
+
+# --- 設定 ---
+BOARD_SIZE = 7
+MODEL_PATH = "fliptac_model.onnx" # .onnx なら ONNX Runtime (CPU)、.pth なら学習済みチェックポイントを torch で使う
+HOST = "127.0.0.1"
+PORT = 8765
+UNIX_SOCKET = None # パスを指定すると TCP の代わりに Unix ソケットで待ち受ける
+MAX_BATCH_SIZE = 64 # 1回の推論にまとめる最大の局面数
+MAX_WAIT_MS = 2.0 # 最初の依頼が来てから、後続の依頼を待つ最長の時間
+STATS_INTERVAL = 30.0 # この秒数ごとに遅延とバッチの埋まり具合を表示する（依頼があったときだけ）
+STATS_WINDOW = 10000 # 統計に使う直近の依頼・バッチの数
+
+
+def load_evaluator(path, size):
+    """path が .onnx なら OnnxEvaluator、それ以外は学習済みチェックポイントを読み込んだ TorchEvaluator"""
+    if path.endswith('.onnx'):
+        return OnnxEvaluator(path)
+    checkpoint = torch.load(path, map_location='cpu')
+    net = build_model(checkpoint.get('model_arch', 'dqn'), size, size)
+    net.load_state_dict(checkpoint['policy_net_state_dict'])
+    return TorchEvaluator(net)
+
+
+class BatchingInferenceServer:
+    """
+    同時に届いた着手の依頼をまとめて1回の推論で評価するサーバー
+    最初の依頼から max_wait_ms 待つか max_batch_size 局面たまったら評価し、各依頼に手を返す。
+    1つの接続は返事を受け取るまで次の依頼を送らないので、開いている接続の数だけたまったら待たずに評価する。
+    推論は1本のスレッドで行うので、その間に届いた依頼は次のバッチにたまる。
+
+    HTTP/1.1（keep-alive 可）で次の2つを受け付ける。
+      POST /move  {"board": size x size の 1(X) / -1(O) / 0, "player": 手番, "last_move": [row, col] か null}
+                  → {"move": [row, col]（有効手がなければ null）, "q": その手のQ値}
+      GET /stats  → 直近の遅延（依頼が届いてから返すまで）の p50 / p99、バッチの大きさと埋まり具合
+    """
+    def __init__(self, evaluator, size, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, stats_window=STATS_WINDOW):
+        self.evaluator = evaluator
+        self.size = size
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.legal_mask = LegalMask()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.latencies = deque(maxlen=stats_window)
+        self.batch_sizes = deque(maxlen=stats_window)
+        self.requests = 0
+        self.connections = 0
+        self.queue = None
+
+    # --- バッチ処理 ---
+    async def predict(self, board, player, last_move):
+        """1局面の最善手を (move, q) で返す（ほかの依頼とまとめて評価される）"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((board, player, last_move, future, time.perf_counter()))
+        return await future
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < min(self.max_batch_size, max(self.connections, 1)):
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0: break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+            try:
+                results = await loop.run_in_executor(self.executor, self._evaluate, batch)
+            except Exception:
+                # 1つの依頼のせいでほかの依頼まで失敗させないよう、1局面ずつ評価し直す
+                results = await loop.run_in_executor(self.executor, self._evaluate_each, batch)
+            now = time.perf_counter()
+            for (*_, future, start), result in zip(batch, results):
+                if future.done(): continue # 接続が切れた依頼は捨てる
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+                self.latencies.append(now - start)
+            self.batch_sizes.append(len(batch))
+            self.requests += len(batch)
+
+    def _evaluate(self, batch):
+        """FlipTacEnv と同じ形の観測と有効手マスクをバッチで作り、有効手の中でQ値が最大の手を選ぶ"""
+        size = self.size
+        boards = np.array([item[0] for item in batch], dtype=np.int8).reshape(-1, size, size)
+        players = np.array([item[1] for item in batch], dtype=np.int8)[:, None, None]
+        states = np.empty((len(batch), 3, size, size), dtype=np.float32)
+        states[:, 0] = boards == players
+        states[:, 1] = boards == -players
+        states[:, 2] = players
+        last_moves = np.zeros((len(batch), 1, size, size), dtype=np.float32)
+        for i, item in enumerate(batch):
+            if item[2] is not None: last_moves[i, 0, item[2][0], item[2][1]] = 1
+        with torch.no_grad():
+            masks = self.legal_mask(torch.from_numpy(states), torch.from_numpy(last_moves)).numpy()
+        q_values = np.where(masks, self.evaluator(states), -np.inf)
+        actions = q_values.argmax(axis=1)
+        return [(None, None) if not mask.any() else ([int(action) // size, int(action) % size], float(q[action]))
+                for mask, q, action in zip(masks, q_values, actions)]
+
+    def _evaluate_each(self, batch):
+        """1局面ずつ評価し、失敗した局面はその例外を結果として返す"""
+        results = []
+        for item in batch:
+            try:
+                results.extend(self._evaluate([item]))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1e3
+        batch_sizes = np.array(self.batch_sizes)
+        if not len(latencies): return {'requests': self.requests}
+        return {'requests': self.requests,
+                'p50_ms': float(np.percentile(latencies, 50)), 'p99_ms': float(np.percentile(latencies, 99)),
+                'mean_batch_size': float(batch_sizes.mean()),
+                'batch_occupancy': float(batch_sizes.mean() / self.max_batch_size)}
+
+    # --- HTTP ---
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                method, path, _ = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''): break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, payload = await self._route(method, path, body)
+                data = b'' if payload is None else json.dumps(payload).encode()
+                # ブラウザ（fliptac_script.js）から直接呼べるように CORS を許可する
+                writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                             "Access-Control-Allow-Origin: *\r\nAccess-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+                             "Access-Control-Allow-Headers: Content-Type\r\n\r\n".encode() + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close': break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def _route(self, method, path, body):
+        if method == 'OPTIONS':
+            return '204 No Content', None
+        if method == 'GET' and path == '/stats':
+            return '200 OK', self.stats()
+        if method == 'POST' and path == '/move':
+            try:
+                request = json.loads(body)
+                board, player, last_move = request['board'], int(request['player']), request.get('last_move')
+                if np.shape(board) != (self.size, self.size) or player not in (1, -1):
+                    raise ValueError(f"board must be {self.size}x{self.size} and player 1 or -1")
+                if not all(v in (1, -1, 0) for row in board for v in row):
+                    raise ValueError("board cells must be 1, -1 or 0")
+                if last_move is not None:
+                    last_move = [int(v) for v in last_move]
+                    if len(last_move) != 2 or not all(0 <= v < self.size for v in last_move):
+                        raise ValueError("last_move must be [row, col] on the board or null")
+            except (ValueError, KeyError, TypeError) as e:
+                return '400 Bad Request', {'error': str(e)}
+            try:
+                move, q = await self.predict(board, player, last_move)
+            except Exception as e:
+                return '500 Internal Server Error', {'error': str(e)}
+            return '200 OK', {'move': move, 'q': q}
+        return '404 Not Found', {'error': f"unknown endpoint: {method} {path}"}
+
+    async def start(self, host=HOST, port=PORT, unix_socket=None):
+        """待ち受けを始め、asyncio のサーバーを返す（port=0 なら空いているポートを使う）"""
+        self.queue = asyncio.Queue()
+        self._batch_task = asyncio.get_running_loop().create_task(self._batch_loop())
+        if unix_socket:
+            return await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    async def serve_forever(self, host=HOST, port=PORT, unix_socket=None, stats_interval=STATS_INTERVAL):
+        server = await self.start(host, port, unix_socket)
+        print(f"Serving on {unix_socket or f'http://{host}:{port}'} "
+              f"(max batch {self.max_batch_size}, max wait {self.max_wait * 1e3:g} ms)")
+        async with server:
+            reported = 0
+            while True:
+                await asyncio.sleep(stats_interval)
+                if self.requests > reported:
+                    reported = self.requests
+                    print(json.dumps(self.stats()))
+
+
+# ===============================================================
+# 計測: 同時に対局するクライアントの数ごとに、まとめない場合（max batch 1）と比べる
+# ===============================================================
+async def _client(host, port, positions, num_requests, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    for i in range(num_requests):
+        body = json.dumps(positions[i % len(positions)]).encode()
+        start = time.perf_counter()
+        writer.write(b"POST /move HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                     + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+        length = 0
+        while True:
+            line = await reader.readline()
+            if line == b'\r\n': break
+            if line.lower().startswith(b'content-length:'): length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def _bench(evaluator, positions, num_clients, max_batch_size, requests_per_client=200):
+    server = BatchingInferenceServer(evaluator, BOARD_SIZE, max_batch_size=max_batch_size)
+    listener = await server.start(HOST, 0)
+    port = listener.sockets[0].getsockname()[1]
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[_client(HOST, port, positions[i::num_clients], requests_per_client, latencies)
+                           for i in range(num_clients)])
+    elapsed = time.perf_counter() - start
+    listener.close()
+    stats = server.stats()
+    latencies = np.array(latencies) * 1e3
+    print(f"{num_clients:3d} clients, max batch {max_batch_size:3d}: {len(latencies) / elapsed:8,.0f} moves/sec | "
+          f"client p50 {np.percentile(latencies, 50):6.2f} ms, p99 {np.percentile(latencies, 99):6.2f} ms | "
+          f"server p50 {stats['p50_ms']:6.2f} ms, p99 {stats['p99_ms']:6.2f} ms | "
+          f"batch {stats['mean_batch_size']:5.1f} ({stats['batch_occupancy']:.0%})")
+
+
+def random_positions(size, num_positions, seed=0):
+    """ランダムな対局から /move に送る依頼を集める"""
+    from FlipTacEnv import FlipTacEnv
+
+    rng = np.random.default_rng(seed)
+    positions = []
+    while len(positions) < num_positions:
+        env = FlipTacEnv(size=size, use_bitboard=True)
+        env.reset()
+        while True:
+            moves = env.get_valid_moves(env.current_player)
+            if not moves: break
+            last = env.last_move[env.current_player]
+            positions.append({'board': env.board.tolist(), 'player': env.current_player,
+                              'last_move': None if last is None else list(last)})
+            env.step(moves[rng.integers(len(moves))])
+    return positions[:num_positions]
+
+
+# --- 実行 ---
+# python inference_server.py [model.onnx|model.pth]       : サーバーを起動する（省略時は MODEL_PATH）
+# python inference_server.py bench [model.onnx|model.pth] : 同時クライアント数ごとの速さと遅延を測る
+#                                                          （モデル省略時は未学習の DQN）
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args and args[0] == 'bench':
+        torch.set_num_threads(1)
+        evaluator = load_evaluator(args[1], BOARD_SIZE) if len(args) > 1 else TorchEvaluator(build_model('dqn', BOARD_SIZE, BOARD_SIZE))
+        positions = random_positions(BOARD_SIZE, 4000)
+        for num_clients in (1, 16, 64):
+            for max_batch_size in (1, MAX_BATCH_SIZE):
+                asyncio.run(_bench(evaluator, positions, num_clients, max_batch_size))
+        sys.exit()
+
+    path = args[0] if args else MODEL_PATH
+    if not os.path.exists(path):
+        sys.exit(f"model not found: {path}")
+    server = BatchingInferenceServer(load_evaluator(path, BOARD_SIZE), BOARD_SIZE)
+    try:
+        asyncio.run(server.serve_forever(HOST, PORT, UNIX_SOCKET))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,202 @@
+import math
+import time
+
+import numpy as np
+import torch
+
+from model import fuse_for_inference
+
+
+class TorchEvaluator:
+    """
+    DQN を1回の forward でまとめて評価する。states: (B, 3, size, size) → Q値 (B, size*size)
+    net は BatchNorm を畳み込んだ推論用の複製にして使う（あとで net の重みを変えても反映されない）
+    """
+    def __init__(self, net, device=None):
+        self.net = fuse_for_inference(net)
+        self.device = device if device is not None else next(net.parameters()).device
+
+    def __call__(self, states):
+        with torch.no_grad():
+            q_values = self.net(torch.from_numpy(states).to(self.device))
+        return q_values.cpu().numpy()
+
+
+class OnnxEvaluator:
+    """export_onnx.py で書き出したモデルを ONNX Runtime (CPU) でまとめて評価する"""
+    def __init__(self, path):
+        import onnxruntime as ort # 任意の依存なので使うときだけ読み込む
+        self.session = ort.InferenceSession(path, providers=['CPUExecutionProvider'])
+        inputs = self.session.get_inputs()
+        if len(inputs) != 1: # *.masked.onnx は 'mask' / 'last_move' も受け取るので、観測だけを渡すここでは使えない
+            raise ValueError(f"{path} は入力が {len(inputs)} 個（{', '.join(i.name for i in inputs)}）あります。"
+                             "観測だけを入力にとる FP32 / INT8 / FP16 の .onnx を指定してください")
+        self.input_name = inputs[0].name
+
+    def __call__(self, states):
+        return self.session.run(None, {self.input_name: states})[0]
+
+
+class _Node:
+    __slots__ = ('prior', 'visits', 'value_sum', 'children', 'pending')
+
+    def __init__(self, prior):
+        self.prior = prior
+        self.visits = 0
+        self.value_sum = 0.0 # このノードに進んだ側から見た価値の合計
+        self.children = None # 未展開なら None、手がなければ空の dict
+        self.pending = False # 評価待ちのバッチに入っている
+
+
+class MCTSPlayer:
+    """
+    DQN のQ値を事前確率に使うモンテカルロ木探索（PUCT）のプレイヤー
+    葉ノードは batch_size 個まとめて1回の推論で評価する（同じ葉を選ばないよう仮想損失を使う）。
+    葉の価値は有効手の最大Q値を tanh で [-1, 1] に縮めたもの、
+    事前確率は有効手のQ値を標準化してから取った softmax（Q値のスケールに左右されないようにする）。
+    """
+    def __init__(self, evaluator, num_simulations=800, batch_size=64, c_puct=1.5,
+                 prior_temperature=1.0, virtual_loss=1.0, time_limit_ms=None):
+        self.evaluator = evaluator
+        self.num_simulations = num_simulations
+        self.batch_size = batch_size
+        self.c_puct = c_puct
+        self.prior_temperature = prior_temperature
+        self.virtual_loss = virtual_loss
+        self.time_limit_ms = time_limit_ms
+        self.last_info = {}
+
+    def select_move(self, env):
+        """env の現在の手番の手を (row, col) で返す。打てる手がなければ None"""
+        if not env.get_valid_moves(env.current_player): return None
+        start = time.perf_counter()
+        deadline = None if self.time_limit_ms is None else start + self.time_limit_ms / 1000
+        root = _Node(1.0)
+        leaves = []
+        self._select_leaf(env, root, leaves, []) # 根だけは先に展開しておく
+        self._evaluate_leaves(leaves)
+        simulations = evaluated = 1
+        collisions = batches = 0
+        batch_fill = 0.0
+        while simulations < self.num_simulations:
+            leaves, collided = [], []
+            target = min(self.batch_size, self.num_simulations - simulations)
+            for _ in range(target):
+                self._select_leaf(env, root, leaves, collided)
+                simulations += 1
+            if leaves:
+                self._evaluate_leaves(leaves)
+                evaluated += len(leaves)
+                batches += 1
+                batch_fill += len(leaves) / self.batch_size
+            for path in collided:
+                self._revert_virtual_loss(path)
+            collisions += len(collided)
+            if deadline is not None and time.perf_counter() > deadline: break
+
+        elapsed = time.perf_counter() - start
+        visits = {move: child.visits for move, child in root.children.items()}
+        self.last_info = {'simulations': simulations, 'evaluated': evaluated,
+                          'nodes_per_sec': evaluated / elapsed if elapsed > 0 else 0.0,
+                          'batches': batches, 'batch_fill': batch_fill / batches if batches else 0.0,
+                          'collisions': collisions, 'time_ms': elapsed * 1000, 'visits': visits}
+        return max(visits, key=visits.get)
+
+    def _select_leaf(self, env, root, leaves, collided):
+        """
+        根から葉まで降りて、評価が必要なら leaves に積む。
+        手がない葉（手番側の負け）はその場で逆伝播する。
+        評価待ちの葉に当たったら経路を collided に積み、仮想損失はバッチの評価が終わるまで残す
+        （残した仮想損失で、同じバッチの以降の選択が別の枝に散らばる）。
+        """
+        path = [root]
+        node = root
+        made = 0
+        while node.children:
+            move, node = self._select_child(node)
+            env.make_move(move)
+            made += 1
+            node.visits += 1
+            node.value_sum -= self.virtual_loss
+            path.append(node)
+
+        if node.children is not None:
+            self._revert_virtual_loss(path)
+            self._backup(path, -1.0) # 手番側が打てない = 負け
+        elif node.pending:
+            collided.append(path)
+        else:
+            moves = env.get_valid_moves(env.current_player)
+            if not moves:
+                node.children = {}
+                self._revert_virtual_loss(path)
+                self._backup(path, -1.0)
+            else:
+                node.pending = True
+                leaves.append((path, env._get_state(), [r * env.size + c for r, c in moves], moves))
+        for _ in range(made):
+            env.unmake_move()
+
+    def _select_child(self, node):
+        sqrt_visits = math.sqrt(max(node.visits, 1))
+        best_score, best = -float('inf'), None
+        for move, child in node.children.items():
+            q = child.value_sum / child.visits if child.visits else 0.0
+            score = q + self.c_puct * child.prior * sqrt_visits / (1 + child.visits)
+            if score > best_score:
+                best_score, best = score, (move, child)
+        return best
+
+    def _evaluate_leaves(self, leaves):
+        q_values = self.evaluator(np.stack([state for _, state, _, _ in leaves]))
+        for (path, _, indices, moves), q in zip(leaves, q_values):
+            legal_q = q[indices].astype(np.float64)
+            logits = (legal_q - legal_q.max()) / ((legal_q.std() + 1e-6) * self.prior_temperature)
+            priors = np.exp(logits)
+            priors /= priors.sum()
+            leaf = path[-1]
+            leaf.children = {move: _Node(p) for move, p in zip(moves, priors)}
+            leaf.pending = False
+            self._revert_virtual_loss(path)
+            self._backup(path, math.tanh(legal_q.max()))
+
+    def _revert_virtual_loss(self, path):
+        for node in path[1:]:
+            node.visits -= 1
+            node.value_sum += self.virtual_loss
+
+    def _backup(self, path, value):
+        """value は葉の手番側から見た価値。各ノードにはそこへ進んだ側から見た価値を足す"""
+        path[0].visits += 1
+        for node in reversed(path[1:]):
+            value = -value
+            node.value_sum += value
+            node.visits += 1
+
+
+# ===============================================================
+# 計測: python mcts.py [model.onnx]（ONNXがなければ未学習のDQNで速度だけ測る）
+# ===============================================================
+if __name__ == '__main__':
+    import sys
+    from FlipTacEnv import FlipTacEnv
+    from model import DQN
+    from search import GreedyPlayer, play_match
+
+    BOARD_SIZE = 5
+    NUM_GAMES = 10
+
+    if len(sys.argv) > 1:
+        evaluator = OnnxEvaluator(sys.argv[1])
+    else:
+        evaluator = TorchEvaluator(DQN(BOARD_SIZE, BOARD_SIZE))
+    for batch_size in (32, 64, 128, 256):
+        player = MCTSPlayer(evaluator, num_simulations=512, batch_size=batch_size)
+        env = FlipTacEnv(size=BOARD_SIZE, use_bitboard=True)
+        player.select_move(env)
+        info = player.last_info
+        print(f"batch {batch_size:3d}: {info['nodes_per_sec']:8,.0f} nodes/sec, batch fill {info['batch_fill']:.2f}, "
+              f"collisions {info['collisions']}, {info['time_ms']:.0f} ms")
+    mcts = MCTSPlayer(evaluator, num_simulations=256, batch_size=32)
+    wins = play_match(mcts, GreedyPlayer(), BOARD_SIZE, NUM_GAMES)
+    print(f"mcts vs greedy: {wins}/{NUM_GAMES} wins")
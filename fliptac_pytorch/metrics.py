@@ -0,0 +1,143 @@
+import cProfile
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from logging.handlers import RotatingFileHandler
+
+
+class _Phase:
+    """
+    with で囲んだ区間の時間を足し込む（区間ごとに使い回すので、呼び出しのたびにオブジェクトを作らない）
+    区間の中に別の区間があれば、その時間は内側の区間にだけ計上する。
+    """
+    __slots__ = ('metrics', 'name', 'start', 'inner')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.metrics._active.append(self)
+        self.inner = 0.0
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        active = self.metrics._active
+        active.pop()
+        if active: active[-1].inner += elapsed
+        self.metrics.seconds[self.name] += elapsed - self.inner
+        self.metrics.calls[self.name] += 1
+
+
+class TrainingMetrics:
+    """
+    学習の段階ごとの時間と回数、カウンタを集計し、interval 秒ごとに1行ずつ書き出す
+    path には JSON Lines で区間ごとの集計を追記し、log_path にはローテーションするログへ要約を書く。
+    時間は CPU 側で測るので、GPU の処理は非同期に進んだ分だけ後の段階に計上される。
+    入れ子の区間は内側の時間を外側から除く（排他時間）ので、各段階の割合 *_share を足しても100%を超えない。
+    """
+    def __init__(self, path='training_metrics.jsonl', log_path='training.log', interval=30.0):
+        self.path = path
+        self.interval = interval
+        self.logger = logging.getLogger('fliptac.train')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        if log_path and not self.logger.handlers:
+            handler = RotatingFileHandler(log_path, maxBytes=1 << 20, backupCount=3)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self.logger.addHandler(handler)
+        self._phases = {}
+        self._active = [] # 今 with の中にいる区間（外側から順）
+        self.start_time = time.perf_counter()
+        self._reset()
+
+    def _reset(self):
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.window_start = time.perf_counter()
+
+    def phase(self, name):
+        """with metrics.phase('env_step'): ... のように使う"""
+        if name not in self._phases:
+            self._phases[name] = _Phase(self, name)
+        return self._phases[name]
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def log_if_due(self, episode, **gauges):
+        """前回の書き出しから interval 秒たっていれば、この区間の集計を書き出してリセットする"""
+        now = time.perf_counter()
+        elapsed = now - self.window_start
+        if elapsed < self.interval: return
+        row = {'time': time.time(), 'elapsed': now - self.start_time, 'episode': episode, 'window_sec': elapsed}
+        for name, n in self.counters.items():
+            row[name] = n
+            row[f'{name}_per_sec'] = n / elapsed
+        row.update(gauges)
+        for name, seconds in self.seconds.items():
+            row[f'{name}_calls'] = self.calls[name]
+            row[f'{name}_ms'] = seconds * 1e3 / self.calls[name]
+            row[f'{name}_share'] = seconds / elapsed
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(row) + '\n')
+        shares = sorted(self.seconds, key=self.seconds.get, reverse=True)
+        self.logger.info(f"episode {episode} | " + ", ".join(f"{name} {row[f'{name}_per_sec']:,.0f}/s" for name in self.counters)
+                         + " | " + ", ".join(f"{name} {row[f'{name}_share']:.0%}" for name in shares)
+                         + "".join(f" | {name} {value:.3g}" for name, value in gauges.items()))
+        self._reset()
+
+
+class ProfileWindow:
+    """
+    start_episode から num_episodes 局の間だけプロファイラを動かし、終わったら out_dir に書き出す
+    mode: 'torch'（torch.profiler、Chrome trace と集計表）か 'cprofile'（pstats 形式）、None なら何もしない
+    """
+    def __init__(self, mode, start_episode, num_episodes, out_dir='profile'):
+        self.mode = mode
+        self.start_episode = start_episode
+        self.stop_episode = start_episode + num_episodes
+        self.out_dir = out_dir
+        self.profiler = None
+
+    def step(self, episode):
+        """各エピソードの始めに呼ぶ"""
+        if self.mode is None: return
+        if self.profiler is None and self.start_episode <= episode < self.stop_episode:
+            self._start()
+        elif self.profiler is not None and episode >= self.stop_episode:
+            self.stop()
+
+    def _start(self):
+        if self.mode == 'torch':
+            import torch.profiler # 使うときだけ読み込む
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available(): activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.profiler.__enter__()
+        elif self.mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            raise ValueError(f"unknown profile mode: {self.mode}")
+
+    def stop(self):
+        """プロファイラを止めて書き出す（学習が途中で終わったときにも呼ぶ）"""
+        if self.profiler is None: return
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = f"episodes_{self.start_episode}_{self.stop_episode}"
+        if self.mode == 'torch':
+            self.profiler.__exit__(None, None, None)
+            self.profiler.export_chrome_trace(os.path.join(self.out_dir, f"{name}.trace.json"))
+            with open(os.path.join(self.out_dir, f"{name}.txt"), 'w') as f:
+                f.write(self.profiler.key_averages().table(sort_by='self_cpu_time_total', row_limit=50))
+        else:
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.out_dir, f"{name}.prof"))
+        self.profiler = None
+        self.mode = None # 1回だけ
@@ -1,6 +1,9 @@
+import copy
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.fusion import fuse_conv_bn_weights
 
 class DQN(nn.Module):
     def __init__(self, h, w):
@@ -23,3 +26,200 @@ class DQN(nn.Module):
         x = x.view(x.size(0), -1) # Flatten
         x = F.relu(self.fc1(x))
         return self.fc2(x)
+
+
+class ConvDQN(nn.Module):
+    """
+    全結合層を持たない DQN（同じ重みをどの盤面サイズでも使える）
+    畳み込みで各マスの特徴を作り、1x1 の畳み込みでマスごとのQ値を出す。
+    h, w は DQN と同じ呼び方で作れるように受け取るだけで使わない。
+    """
+    def __init__(self, h=None, w=None, channels=32, head_channels=64):
+        super(ConvDQN, self).__init__()
+        self.conv1 = nn.Conv2d(3, 16, kernel_size=3, stride=1, padding=1)
+        self.bn1 = nn.BatchNorm2d(16)
+        self.conv2 = nn.Conv2d(16, channels, kernel_size=3, stride=1, padding=1)
+        self.bn2 = nn.BatchNorm2d(channels)
+        self.conv3 = nn.Conv2d(channels, channels, kernel_size=3, stride=1, padding=1)
+        self.bn3 = nn.BatchNorm2d(channels)
+        self.conv4 = nn.Conv2d(channels, channels, kernel_size=3, stride=1, padding=1) # 各マスから9x9の範囲が見える
+        self.bn4 = nn.BatchNorm2d(channels)
+
+        # マスごとの出力（1x1 畳み込み）
+        self.head1 = nn.Conv2d(channels, head_channels, kernel_size=1)
+        self.head2 = nn.Conv2d(head_channels, 1, kernel_size=1)
+
+    def forward(self, x):
+        x = F.relu(self.bn1(self.conv1(x)))
+        x = F.relu(self.bn2(self.conv2(x)))
+        x = F.relu(self.bn3(self.conv3(x)))
+        x = F.relu(self.bn4(self.conv4(x)))
+        x = F.relu(self.head1(x))
+        return self.head2(x).flatten(1) # (B, h*w)、並びは DQN と同じ row * w + col
+
+
+MODEL_ARCHS = {'dqn': DQN, 'conv': ConvDQN}
+
+def build_model(arch, h, w):
+    """arch: 'dqn'（全結合の出力層）か 'conv'（盤面サイズによらない全畳み込み）"""
+    return MODEL_ARCHS[arch](h, w)
+
+
+def fuse_for_inference(model, out=None):
+    """
+    BatchNorm を直前の畳み込みの重みとバイアスに畳み込んだ推論専用の複製を返す（model は変えない）
+    model の bnN は convN の直後にあるものとして畳み込み、複製では何もしない層に置き換える。
+    BatchNorm は学習時の移動平均を使うので、結果は model.eval() と同じになる。
+    out に前回この関数で作った複製を渡すと、新しく作らずにその重みだけを書き換える。
+    返すモジュールは推論モードのまま勾配を持たず、torch.jit.script / torch.compile にそのまま渡せる。
+    """
+    if out is None:
+        out = copy.deepcopy(model)
+        for name, module in list(out.named_children()):
+            if isinstance(module, nn.BatchNorm2d):
+                setattr(out, name, nn.Identity())
+        out.zero_grad(set_to_none=True)
+        out.eval().requires_grad_(False)
+    folded = {}
+    for name, module in model.named_children():
+        if isinstance(module, nn.BatchNorm2d):
+            conv_name = 'conv' + name[len('bn'):]
+            conv = getattr(model, conv_name)
+            folded[f'{conv_name}.weight'], folded[f'{conv_name}.bias'] = fuse_conv_bn_weights(
+                conv.weight, conv.bias, module.running_mean, module.running_var, module.eps, module.weight, module.bias)
+    params = dict(model.named_parameters())
+    with torch.no_grad():
+        for name, param in out.named_parameters():
+            param.copy_(folded.get(name, params[name]))
+    return out
+
+
+def script_for_inference(model):
+    """fuse_for_inference した複製を TorchScript にして freeze する（重みを定数として埋め込み、演算をまとめる）"""
+    return torch.jit.freeze(torch.jit.script(fuse_for_inference(model)))
+
+
+def masked_argmax(q_values, mask):
+    """
+    有効手だけからQ値が最大の行動をバッチ全体で一度に選ぶ
+    q_values: (B, size*size)、mask: (B, size*size) の bool（True が有効手）
+    """
+    return q_values.masked_fill(~mask, -float('inf')).argmax(dim=1)
+
+
+class LegalMask(nn.Module):
+    """
+    観測 state (B, 3, h, w) と、手番のプレイヤーが最後に置いたマスだけ 1 の last_move (B, 1, h, w)
+    （初手ならすべて 0）から有効手マスク (B, h*w) を作る。規則は FlipTacEnv.legal_mask と同じ。
+    固定の重みの畳み込みだけで書いているので、盤面サイズによらずそのまま ONNX に書き出せる。
+    """
+    def __init__(self):
+        super(LegalMask, self).__init__()
+        jump = torch.zeros(4, 1, 5, 5)
+        over = torch.zeros(4, 1, 5, 5)
+        for k, (dr, dc) in enumerate(((-1, 0), (1, 0), (0, -1), (0, 1))):
+            jump[k, 0, 2 - 2 * dr, 2 - 2 * dc] = 1 # 2マス先に置くとき、最後に置いたマス
+            over[k, 0, 2 - dr, 2 - dc] = 1 # そのとき飛び越えるマス
+        self.register_buffer('near', torch.ones(1, 1, 3, 3))
+        self.register_buffer('jump', jump)
+        self.register_buffer('over', over)
+
+    def forward(self, state, last_move):
+        own, opponent = state[:, 0:1], state[:, 1:2]
+        near = F.conv2d(last_move, self.near, padding=1) > 0
+        # 上下左右の2マス先は、間のマスに相手のマークがあるときだけ
+        jump = (F.conv2d(last_move, self.jump, padding=2) * F.conv2d(opponent, self.over, padding=2)).sum(1, keepdim=True) > 0
+        # 初手は外周（周りの9マスが盤面に収まらないマス）
+        edge = F.conv2d(torch.ones_like(last_move), self.near, padding=1) < 9
+        first = last_move.flatten(1).amax(dim=1) == 0
+        first = first[:, None, None, None]
+        candidates = (first & edge) | (~first & (near | jump))
+        return (candidates & ((own + opponent) == 0)).flatten(1)
+
+
+class MaskedPolicy(nn.Module):
+    """
+    net のQ値を有効手に絞って最善手まで選ぶモデル（ONNX に書き出し、1回の推論で手を決めるのに使う）
+    forward(state, mask) → (action (B,), 無効手を -inf にしたQ値 (B, h*w))
+    derive_mask=True なら mask の代わりに LegalMask の last_move を受け取り、有効手をグラフの中で求める。
+    有効手が1つもない局面では、Q値がすべて -inf になる（action は 0）。
+    """
+    def __init__(self, net, derive_mask=False):
+        super(MaskedPolicy, self).__init__()
+        self.net = net
+        self.legal_mask = LegalMask() if derive_mask else None
+
+    def forward(self, state, mask):
+        if self.legal_mask is not None:
+            mask = self.legal_mask(state, mask)
+        q_values = self.net(state).masked_fill(~mask, -float('inf'))
+        return q_values.argmax(dim=1), q_values
+
+
+def soft_update(target, source, tau):
+    """
+    target ← tau * source + (1 - tau) * target をパラメータとバッファに直接書き込む
+    浮動小数点のテンソルは foreach の lerp でまとめて更新し、
+    BatchNorm の num_batches_tracked のような整数のバッファはそのまま写す。
+    """
+    with torch.no_grad():
+        target_floats, source_floats = [], []
+        for dst, src in zip(list(target.parameters()) + list(target.buffers()),
+                            list(source.parameters()) + list(source.buffers())):
+            if dst.is_floating_point():
+                target_floats.append(dst)
+                source_floats.append(src)
+            else:
+                dst.copy_(src)
+        torch._foreach_lerp_(target_floats, source_floats, tau)
+
+
+# ===============================================================
+# 数値の確認: python model.py
+# （BatchNorm を畳み込んだモデルが、元のモデルの eval() と同じQ値を出すか）
+# ===============================================================
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    for arch in MODEL_ARCHS:
+        for size in (5, 7):
+            model = build_model(arch, size, size)
+            # 学習後に近づけるため、BatchNorm の統計と係数をでたらめな値にしておく
+            for module in model.modules():
+                if isinstance(module, nn.BatchNorm2d):
+                    module.running_mean.uniform_(-1, 1)
+                    module.running_var.uniform_(0.5, 2)
+                    nn.init.uniform_(module.weight, 0.5, 1.5)
+                    nn.init.uniform_(module.bias, -0.5, 0.5)
+            fused = fuse_for_inference(model)
+            scripted = script_for_inference(model)
+            model.eval()
+            x = torch.randint(0, 2, (256, 3, size, size)).float()
+            with torch.no_grad():
+                expected = model(x)
+                for name, candidate in (('fused', fused), ('scripted', scripted)):
+                    q_values = candidate(x)
+                    error = ((q_values - expected).abs().max() / expected.abs().max()).item()
+                    assert error < 1e-5, (arch, size, name, error)
+                    assert (q_values.argmax(dim=1) == expected.argmax(dim=1)).all(), (arch, size, name)
+                # 重みを書き換えたあとに out で作り直しても同じになるか
+                model.train()
+                model(x)
+                model.eval()
+                assert torch.allclose(fuse_for_inference(model, out=fused)(x), model(x), rtol=1e-4, atol=1e-5)
+            print(f"{arch} {size}x{size}: OK")
+
+    # LegalMask が環境と同じ有効手を返すか（ランダムな対局の全局面で）
+    import numpy as np
+    from VecFlipTacEnv import VecFlipTacEnv
+
+    rng = np.random.default_rng(0)
+    legal_mask = LegalMask()
+    for size in (5, 7):
+        env = VecFlipTacEnv(256, size=size)
+        state = env.reset()
+        for _ in range(60):
+            expected = env.legal_mask()
+            mask = legal_mask(torch.from_numpy(state), torch.from_numpy(env.last_move_planes()))
+            assert (mask.numpy() == expected).all(), size
+            state = env.step((rng.random(expected.shape) * expected).argmax(axis=1))[0]
+        print(f"legal mask {size}x{size}: OK")
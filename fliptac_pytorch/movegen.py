@@ -0,0 +1,39 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def edge_candidates(size):
+    """初手で置ける外周マスの一覧（盤面サイズごとにキャッシュ）"""
+    return tuple((r, c, None) for r in range(size) for c in range(size)
+                 if r == 0 or r == size - 1 or c == 0 or c == size - 1)
+
+
+@lru_cache(maxsize=None)
+def neighbour_candidates(size):
+    """
+    各マスから次に置ける可能性のあるマスの表（盤面サイズごとにキャッシュ）
+    周囲8マスと上下左右2マス先の最大12マスを、盤面の走査順に並べる。
+    """
+    table = {}
+    for r in range(size):
+        for c in range(size):
+            candidates = []
+            for rr in range(max(r - 2, 0), min(r + 3, size)):
+                for cc in range(max(c - 2, 0), min(c + 3, size)):
+                    dr, dc = rr - r, cc - c
+                    if max(abs(dr), abs(dc)) == 1:
+                        candidates.append((rr, cc, None))
+                    elif (dr == 0 and abs(dc) == 2) or (dc == 0 and abs(dr) == 2):
+                        candidates.append((rr, cc, (r + dr // 2, c + dc // 2)))
+            table[(r, c)] = tuple(candidates)
+    return table
+
+
+def candidate_moves(size, last_pos):
+    """
+    有効手になりうるマスを (row, col, 飛び越えるマス) の形で返す。
+    飛び越えるマスが None なら空きマスであれば有効、
+    そうでなければ飛び越えるマスに相手のマークがあるときだけ有効。
+    """
+    if last_pos is None: return edge_candidates(size)
+    return neighbour_candidates(size)[tuple(last_pos)]
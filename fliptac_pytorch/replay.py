@@ -0,0 +1,327 @@
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import torch
+from numpy.lib.format import open_memmap
+
+
+def pack_states(states):
+    """
+    観測 (B, 3, size, size) を (自分と相手の石のビット列, 手番) に詰める
+    7x7 なら1局面あたり石13バイト + 手番1バイト。
+    """
+    states = np.asarray(states)
+    stones = states[:, :2].reshape(len(states), 2 * states.shape[2] * states.shape[3]) > 0.5
+    return np.packbits(stones, axis=1), states[:, 2, 0, 0].astype(np.int8)
+
+
+def unpack_states(packed, sides, size):
+    """pack_states の逆変換。float32 の観測 (B, 3, size, size) をまとめて作り直す"""
+    n = size * size
+    states = np.empty((len(packed), 3, size, size), dtype=np.float32)
+    states[:, :2] = np.unpackbits(packed, axis=1, count=2 * n).reshape(len(packed), 2, size, size)
+    states[:, 2] = sides[:, None, None]
+    return states
+
+
+def _write_npy(path, array, chunk_size):
+    """大きな配列も一時的な複製を作らず、chunk_size 行ずつ .npy に書き出す"""
+    out = open_memmap(path, mode='w+', dtype=array.dtype, shape=array.shape)
+    for start in range(0, len(array), chunk_size):
+        out[start:start + chunk_size] = array[start:start + chunk_size]
+    out.flush()
+    del out
+
+
+def saved_replay_dir(directory):
+    """
+    directory に save された Replay Memory があれば、最新の保存先のディレクトリを返す（なければ None）
+    current.json が指す番号つきのディレクトリか、古い形式で directory に直接書いたもの。
+    """
+    pointer = os.path.join(directory, 'current.json')
+    if os.path.exists(pointer):
+        with open(pointer) as f:
+            path = os.path.join(directory, json.load(f)['dir'])
+        return path if os.path.exists(os.path.join(path, 'meta.json')) else None
+    if os.path.exists(os.path.join(directory, 'meta.json')): return directory
+    return None
+
+
+class ReplayBuffer:
+    """
+    事前に確保した連続配列によるリングバッファ型の Replay Memory
+    局面はビット列に詰めて保存し、サンプリング時にまとめて観測へ戻す。
+    容量に達したら古い経験から上書きし、サンプリングはインデックスでまとめて取り出す。
+    """
+    _FIELDS = ('states', 'sides', 'next_states', 'next_sides', 'actions', 'rewards', 'dones')
+
+    def __init__(self, capacity, state_shape, device='cpu', seed=None):
+        self.capacity = capacity
+        self.device = device
+        self.board_size = state_shape[-1]
+        nbytes = (2 * self.board_size * self.board_size + 7) // 8
+        self.states = np.zeros((capacity, nbytes), dtype=np.uint8)
+        self.sides = np.zeros(capacity, dtype=np.int8)
+        self.next_states = np.zeros((capacity, nbytes), dtype=np.uint8)
+        self.next_sides = np.zeros(capacity, dtype=np.int8)
+        self.actions = np.zeros(capacity, dtype=np.int16)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.position = 0
+        self.size = 0
+        self.mapped_dir = None # load でメモリマップしているディレクトリ
+        self.rng = np.random.default_rng(seed)
+
+    def push(self, state, action, next_state, reward, done):
+        """action は盤面のインデックス (row * size + col)。done なら next_state は使われない"""
+        packed, side = pack_states(np.asarray(state)[None])
+        next_packed, next_side = pack_states(np.asarray(next_state)[None])
+        self.push_packed(packed[0], side[0], action, next_packed[0], next_side[0], reward, done)
+
+    def push_batch(self, states, actions, next_states, rewards, dones):
+        """観測 (B, 3, size, size) の経験をまとめて詰めて書き込む"""
+        packed, sides = pack_states(states)
+        next_packed, next_sides = pack_states(next_states)
+        return self.push_packed_batch(packed, sides, actions, next_packed, next_sides, rewards, dones)
+
+    def push_packed(self, state, side, action, next_state, next_side, reward, done):
+        i = self.position
+        self.states[i], self.sides[i] = state, side
+        self.next_states[i], self.next_sides[i] = next_state, next_side
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.dones[i] = done
+        self.position = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def push_packed_batch(self, states, sides, actions, next_states, next_sides, rewards, dones):
+        """詰めた経験をまとめて書き込む（actor から届いた塊用）。書き込んだインデックスを返す"""
+        indices = (self.position + np.arange(len(actions))) % self.capacity
+        self.states[indices], self.sides[indices] = states, sides
+        self.next_states[indices], self.next_sides[indices] = next_states, next_sides
+        self.actions[indices] = actions
+        self.rewards[indices] = rewards
+        self.dones[indices] = dones
+        self.position = (self.position + len(actions)) % self.capacity
+        self.size = min(self.size + len(actions), self.capacity)
+        return indices
+
+    def sample_indices(self, batch_size):
+        return self.rng.integers(0, self.size, size=batch_size)
+
+    def gather(self, indices):
+        """(states, actions, next_states, rewards, dones) を device 上のテンソルで返す"""
+        to = lambda a: torch.from_numpy(a).to(self.device)
+        states = unpack_states(self.states[indices], self.sides[indices], self.board_size)
+        next_states = unpack_states(self.next_states[indices], self.next_sides[indices], self.board_size)
+        return (to(states), to(self.actions[indices].astype(np.int64)), to(next_states),
+                to(self.rewards[indices]), to(self.dones[indices]))
+
+    def sample(self, batch_size):
+        return self.gather(self.sample_indices(batch_size))
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self._FIELDS)
+
+    def _arrays(self):
+        return {name: getattr(self, name) for name in self._FIELDS}
+
+    def _meta(self):
+        return {'capacity': self.capacity, 'board_size': self.board_size, 'position': self.position, 'size': self.size}
+
+    def snapshot(self):
+        """
+        今の位置・件数と配列の複製を (meta, arrays) で返す。別スレッドで save するときは、保存を依頼した時点でこれを渡す
+        7x7 なら1件35バイトなので、学習のスレッドで複製しても軽い。
+        """
+        return self._meta(), {name: np.array(array) for name, array in self._arrays().items()}
+
+    def save(self, directory, snapshot=None, chunk_size=1 << 20):
+        """
+        配列ごとに .npy へ書き出す。保存のたびに directory の下の新しい番号のディレクトリに書き切ってから
+        current.json をそこへ向け直すので、途中で止まっても前回の保存が残る。
+        前の保存は、このプロセスがメモリマップしていなければ消す（Windows ではマップ中のファイルを消せない）。
+        学習を続けながら別スレッドで呼ぶときは snapshot() を渡す（書き出し中に push されても保存する中身は変わらない）。
+        """
+        meta, arrays = snapshot if snapshot is not None else (self._meta(), self._arrays())
+        os.makedirs(directory, exist_ok=True)
+        numbers = [int(f) for f in os.listdir(directory) if re.fullmatch(r'\d+', f)]
+        name = f"{max(numbers, default=0) + 1:06d}"
+        tmp_dir = os.path.join(directory, name + '.tmp')
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for array_name, array in arrays.items():
+            _write_npy(os.path.join(tmp_dir, array_name + '.npy'), array, chunk_size)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_dir, os.path.join(directory, name))
+        pointer = os.path.join(directory, 'current.json')
+        with open(pointer + '.tmp', 'w') as f:
+            json.dump({'dir': name}, f)
+        os.replace(pointer + '.tmp', pointer)
+        mapped = os.path.abspath(self.mapped_dir) if self.mapped_dir else None
+        for f in os.listdir(directory):
+            path = os.path.join(directory, f)
+            if f != name and re.fullmatch(r'\d+(\.tmp)?', f) and os.path.abspath(path) != mapped:
+                shutil.rmtree(path, ignore_errors=True)
+            elif (f == 'meta.json' or f.endswith('.npy')) and os.path.abspath(directory) != mapped:
+                os.remove(path) # 古い形式で directory に直接書いた保存
+
+    def load(self, directory):
+        """
+        save で書き出した最新の経験をメモリマップで読み込む（mmap_mode='c'）
+        読み込み時にはファイルを RAM へ写さず、触れたページだけが読まれる。
+        書き込んだページはこのプロセスだけの複製になり、ファイルは変わらない。
+        """
+        directory = saved_replay_dir(directory)
+        if directory is None: raise FileNotFoundError("no saved replay memory")
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['capacity'] != self.capacity or meta['board_size'] != self.board_size:
+            raise ValueError(f"saved replay memory has capacity {meta['capacity']} and board size {meta['board_size']}")
+        for name in self._arrays():
+            setattr(self, name, np.load(os.path.join(directory, name + '.npy'), mmap_mode='c'))
+        self.position, self.size = meta['position'], meta['size']
+        self.mapped_dir = directory
+        return meta
+
+    def __len__(self):
+        return self.size
+
+
+class SumTree:
+    """
+    配列で持つ和の木（葉が各経験の優先度、親が子の和）
+    更新もサンプリングも O(log n) で、どちらもバッチ単位でまとめて行う。
+    """
+    def __init__(self, capacity):
+        self.leaf_start = 1 << max(int(np.ceil(np.log2(capacity))), 1)
+        self.depth = self.leaf_start.bit_length() - 1
+        self.tree = np.zeros(2 * self.leaf_start, dtype=np.float64)
+
+    def total(self):
+        return self.tree[1]
+
+    def priorities(self, indices):
+        return self.tree[indices + self.leaf_start]
+
+    def update(self, indices, priorities):
+        nodes = np.asarray(indices) + self.leaf_start
+        self.tree[nodes] = priorities
+        # 同じ親が重複しても書き込む値は同じなので、そのまま上に辿る
+        for _ in range(self.depth):
+            nodes = nodes // 2
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def update_one(self, index, priority):
+        """1件だけの更新（push のたびに呼ばれるので配列演算を使わない）"""
+        tree = self.tree
+        node = index + self.leaf_start
+        tree[node] = priority
+        while node > 1:
+            node >>= 1
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+
+    def find(self, values):
+        """累積和が values に達する葉のインデックスを、全サンプル同時に根から降りて求める"""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            go_right = values > left_sum
+            values -= np.where(go_right, left_sum, 0.0)
+            nodes = left + go_right
+        return nodes - self.leaf_start
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    TD誤差に応じた優先度で経験を選ぶ Replay Memory（Prioritized Experience Replay）
+    新しい経験にはそれまでの最大優先度を与え、sample は重要度サンプリングの重みも返す。
+    """
+    def __init__(self, capacity, state_shape, device='cpu', alpha=0.6, epsilon=1e-5, seed=None):
+        super().__init__(capacity, state_shape, device, seed)
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def push_packed(self, state, side, action, next_state, next_side, reward, done):
+        i = self.position
+        super().push_packed(state, side, action, next_state, next_side, reward, done)
+        self.tree.update_one(i, self.max_priority ** self.alpha)
+
+    def push_packed_batch(self, states, sides, actions, next_states, next_sides, rewards, dones):
+        indices = super().push_packed_batch(states, sides, actions, next_states, next_sides, rewards, dones)
+        self.tree.update(indices, np.full(len(indices), self.max_priority ** self.alpha))
+        return indices
+
+    def sample_indices(self, batch_size):
+        # 全体を batch_size 等分して、各区間から1つずつ選ぶ
+        segment = self.tree.total() / batch_size
+        values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+        return np.minimum(self.tree.find(values), self.size - 1)
+
+    def sample(self, batch_size, beta=0.4):
+        """(states, actions, next_states, rewards, dones, weights, indices) を返す"""
+        indices = self.sample_indices(batch_size)
+        probabilities = self.tree.priorities(indices) / self.tree.total()
+        weights = (self.size * probabilities) ** (-beta)
+        weights /= weights.max()
+        weights = torch.from_numpy(weights.astype(np.float32)).to(self.device)
+        return (*self.gather(indices), weights, indices)
+
+    def _arrays(self):
+        arrays = super()._arrays()
+        arrays['priorities'] = self.tree.priorities(np.arange(self.capacity))
+        return arrays
+
+    def _meta(self):
+        return {**super()._meta(), 'max_priority': self.max_priority}
+
+    def load(self, directory):
+        meta = super().load(directory)
+        self.tree.update(np.arange(self.capacity), self.priorities)
+        del self.priorities # 木に入れ直したので、マップしたままにしない
+        self.max_priority = meta['max_priority']
+        return meta
+
+    def update_priorities(self, indices, td_errors):
+        priorities = np.abs(td_errors) + self.epsilon
+        self.tree.update(indices, priorities ** self.alpha)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
+
+
+# ===============================================================
+# 保存の確認: python replay.py
+# （リングが一周した後に snapshot を取り、書き出しの前に push しても、snapshot の時点の経験が戻るか）
+# ===============================================================
+if __name__ == '__main__':
+    import tempfile
+
+    for buffer_class in (ReplayBuffer, PrioritizedReplayBuffer):
+        memory = buffer_class(10, (3, 5, 5), seed=0)
+        prioritized = isinstance(memory, PrioritizedReplayBuffer)
+        push = lambda i: memory.push_packed(np.full(7, i, np.uint8), 1, i, np.full(7, i, np.uint8), -1, float(i), False)
+        for i in range(13): push(i)
+        if prioritized: memory.update_priorities(np.arange(10), np.arange(1.0, 11.0))
+        snapshot = memory.snapshot()
+        expected = {name: np.array(array) for name, array in memory._arrays().items()}
+        for i in range(13, 15): push(i) # 書き出しの前に、保存を依頼した後の経験が入る
+        if prioritized: memory.update_priorities(np.arange(10), np.zeros(10))
+        with tempfile.TemporaryDirectory() as directory:
+            memory.save(directory, snapshot)
+            loaded = buffer_class(10, (3, 5, 5), seed=0)
+            loaded.load(directory)
+            assert (loaded.position, loaded.size) == (3, 10), (loaded.position, loaded.size)
+            # サンプリングする範囲 [0, size) は snapshot の時点の 3〜12 番目の経験だけ
+            assert sorted(loaded.rewards[:loaded.size]) == list(range(3, 13)), loaded.rewards
+            assert set(loaded.rewards[loaded.sample_indices(1000)]) <= set(range(3, 13))
+            for name, array in loaded._arrays().items():
+                assert np.allclose(array, expected[name]), name
+            del loaded # Windows ではマップしたままだと消せない
+        print(f"{buffer_class.__name__}: OK")
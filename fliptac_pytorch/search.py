@@ -0,0 +1,206 @@
+import random
+import time
+
+from FlipTacEnv import FlipTacEnv
+from zobrist import TranspositionTable, get_shared_table
+
+WIN = 10000 # 勝ち確定の評価値（早く勝つほど大きくなるよう手数を引く）
+MATE_BOUND = WIN - 1000
+
+
+class _SearchTimeout(Exception):
+    pass
+
+
+def _to_table(value, ply):
+    # 勝敗確定の値はルートからの手数ではなく、その局面からの手数で保存する
+    if value > MATE_BOUND: return value + ply
+    if value < -MATE_BOUND: return value - ply
+    return value
+
+
+def _from_table(value, ply):
+    if value > MATE_BOUND: return value - ply
+    if value < -MATE_BOUND: return value + ply
+    return value
+
+
+class AlphaBetaPlayer:
+    """
+    反復深化つき negamax/αβ探索のCPUプレイヤー
+    time_limit_ms の思考時間で読み切れた最も深い探索の最善手を返す。
+    思考時間の半分を過ぎたら次の深さには進まない（次の深さは読み切れず、途中で打ち切ることになるため）。
+    手の並べ替えは置換表の最善手 → 相手の有効手が少なくなる手（shortest() と同じ基準）の順。
+    """
+    def __init__(self, time_limit_ms=50, max_depth=64, table=None):
+        self.time_limit_ms = time_limit_ms
+        self.max_depth = max_depth
+        self.table = table if table is not None else get_shared_table()
+        self.last_info = {}
+
+    def select_move(self, env):
+        """env の現在の手番の手を (row, col) で返す。打てる手がなければ None"""
+        moves = env.get_valid_moves(env.current_player)
+        if not moves: return None
+        start = time.perf_counter()
+        # 最後の数ノードや後始末の分だけ早めに打ち切る
+        self._deadline = start + self.time_limit_ms / 1000 * 0.95
+        self._half_time = start + self.time_limit_ms / 1000 / 2
+        self._made = 0
+        self.nodes = 0
+        self.table.new_search()
+
+        best_move, best_value, completed_depth = moves[0], None, 0
+        for depth in range(1, self.max_depth + 1):
+            try:
+                value, move = self._search_root(env, moves, depth, best_move)
+            except _SearchTimeout:
+                # 途中で打ち切った探索の手は使わず、盤面だけ元に戻す
+                for _ in range(self._made):
+                    env.unmake_move()
+                self._made = 0
+                break
+            best_value, best_move, completed_depth = value, move, depth
+            if abs(value) > MATE_BOUND or len(moves) == 1: break
+            if time.perf_counter() > self._half_time: break
+
+        elapsed = time.perf_counter() - start
+        self.last_info = {'depth': completed_depth, 'value': best_value, 'nodes': self.nodes,
+                          'time_ms': elapsed * 1000, 'table': self.table.stats()}
+        return best_move
+
+    def _search_root(self, env, moves, depth, first_move):
+        alpha, beta = -WIN - 1, WIN + 1
+        best_move = None
+        for move in self._order_moves(env, moves, first_move, depth):
+            value = -self._negamax_child(env, move, depth - 1, -beta, -alpha, 1)
+            if best_move is None or value > alpha:
+                alpha, best_move = value, move
+        self.table.store(env.hash, depth, _to_table(alpha, 0), TranspositionTable.EXACT, best_move)
+        return alpha, best_move
+
+    def _negamax_child(self, env, move, depth, alpha, beta, ply):
+        env.make_move(move)
+        self._made += 1
+        value = self._negamax(env, depth, alpha, beta, ply)
+        env.unmake_move()
+        self._made -= 1
+        return value
+
+    def _negamax(self, env, depth, alpha, beta, ply):
+        self.nodes += 1
+        if self.nodes & 7 == 0 and time.perf_counter() > self._deadline:
+            raise _SearchTimeout()
+
+        player = env.current_player
+        moves = env.get_valid_moves(player)
+        if not moves: return -WIN + ply # 手番側が打てなければ負け
+        if depth == 0: return self._evaluate(env, player, len(moves))
+
+        alpha_orig = alpha
+        table_move = None
+        entry = self.table.probe(env.hash)
+        if entry is not None:
+            entry_depth, entry_value, flag, table_move = entry
+            if entry_depth >= depth:
+                entry_value = _from_table(entry_value, ply)
+                if flag == TranspositionTable.EXACT: return entry_value
+                if flag == TranspositionTable.LOWER: alpha = max(alpha, entry_value)
+                else: beta = min(beta, entry_value)
+                if alpha >= beta: return entry_value
+
+        best_value, best_move = -WIN - 1, None
+        for move in self._order_moves(env, moves, table_move, depth):
+            value = -self._negamax_child(env, move, depth - 1, -beta, -alpha, ply + 1)
+            if value > best_value:
+                best_value, best_move = value, move
+            if value > alpha:
+                alpha = value
+                if alpha >= beta: break
+
+        if best_value <= alpha_orig: flag = TranspositionTable.UPPER
+        elif best_value >= beta: flag = TranspositionTable.LOWER
+        else: flag = TranspositionTable.EXACT
+        self.table.store(env.hash, depth, _to_table(best_value, ply), flag, best_move)
+        return best_value
+
+    def _order_moves(self, env, moves, first_move, depth):
+        if depth < 2:
+            return sorted(moves, key=lambda m: m != first_move)
+        scored = []
+        for move in moves:
+            # 並べ替えでも子局面を1つずつ作るので、ここでも時間を確かめる
+            if time.perf_counter() > self._deadline: raise _SearchTimeout()
+            env.make_move(move)
+            scored.append((move != first_move, env.count_valid_moves(env.current_player), move))
+            env.unmake_move()
+        scored.sort()
+        return [move for _, _, move in scored]
+
+    def _evaluate(self, env, player, my_moves):
+        # 手番側から見た有効手数の差（FlipTacEnv のポテンシャルと同じ重み）
+        return my_moves - env.count_valid_moves(-player) * 1.5
+
+
+class GreedyPlayer:
+    """FlipTac3.3.py の shortest() と同じ1手読み（相手の有効手数最小 → 相手の最後の手に近い順）"""
+    def select_move(self, env):
+        player = env.current_player
+        moves = env.get_valid_moves(player)
+        if not moves: return None
+        scored = []
+        for move in moves:
+            env.make_move(move)
+            scored.append((env.count_valid_moves(-player), move))
+            env.unmake_move()
+        min_moves = min(count for count, _ in scored)
+        best_moves = [move for count, move in scored if count == min_moves]
+        last = env.last_move[-player]
+        if last is None: return best_moves[0]
+        return min(best_moves, key=lambda m: (last[0] - m[0]) ** 2 + (last[1] - m[1]) ** 2)
+
+
+def play_match(player_x, player_o, size=7, num_games=20, random_opening=2, seed=0):
+    """
+    2つのプレイヤーを対戦させ、X(先手)側の勝数を返す
+    序盤の random_opening 手ずつはランダムに打ち、対局に変化をつける。
+    """
+    rng = random.Random(seed)
+    x_wins = 0
+    for _ in range(num_games):
+        env = FlipTacEnv(size=size, use_bitboard=True)
+        players = {1: player_x, -1: player_o}
+        ply = 0
+        while True:
+            moves = env.get_valid_moves(env.current_player)
+            if not moves:
+                x_wins += env.current_player == -1
+                break
+            if ply < 2 * random_opening: move = rng.choice(moves)
+            else: move = players[env.current_player].select_move(env)
+            env.make_move(move)
+            ply += 1
+    return x_wins
+
+
+# ===============================================================
+# 評価: python search.py（αβ探索 vs 従来の shortest() 相当）
+# ===============================================================
+if __name__ == '__main__':
+    BOARD_SIZE = 7
+    NUM_GAMES = 20
+
+    alpha_beta, greedy = AlphaBetaPlayer(time_limit_ms=50), GreedyPlayer()
+    depths, times = [], []
+    class _Recording:
+        def select_move(self, env):
+            move = alpha_beta.select_move(env)
+            depths.append(alpha_beta.last_info['depth'])
+            times.append(alpha_beta.last_info['time_ms'])
+            return move
+    wins = play_match(_Recording(), greedy, BOARD_SIZE, NUM_GAMES)
+    wins += NUM_GAMES - play_match(greedy, _Recording(), BOARD_SIZE, NUM_GAMES, seed=1)
+    print(f"alpha-beta vs greedy: {wins}/{2 * NUM_GAMES} wins")
+    print(f"depth: avg {sum(depths) / len(depths):.1f}, max {max(depths)} / think time: avg {sum(times) / len(times):.1f} ms, "
+          f"max {max(times):.1f} ms, over {alpha_beta.time_limit_ms} ms: {sum(t > alpha_beta.time_limit_ms for t in times)}/{len(times)}")
+    print(f"table: {alpha_beta.table.stats()}")
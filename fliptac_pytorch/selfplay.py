@@ -0,0 +1,63 @@
+import numpy as np
+import torch
+
+from VecFlipTacEnv import VecFlipTacEnv
+from model import masked_argmax
+
+
+class LockstepSelfPlay:
+    """
+    num_games 局を同時に1手ずつ進める自己対戦
+    1手ごとに、手番のネットワークが同じゲームを集めて1回の forward でまとめて評価する。
+    X(1) は policy_net で ε-greedy、O(-1) はゲームごとに choose_opponent() で選んだネットワークで打つ。
+    終わったゲームはその場でリセットされ、相手も選び直される。
+    """
+    def __init__(self, num_games, size, policy_net, choose_opponent, device='cpu', seed=None):
+        self.env = VecFlipTacEnv(num_games, size=size)
+        self.size = size
+        self.policy_net = policy_net
+        self.choose_opponent = choose_opponent
+        self.device = device
+        self.rng = np.random.default_rng(seed)
+        self.opponents = [choose_opponent() for _ in range(num_games)]
+        self.state = self.env.reset()
+
+    def _nets(self):
+        players = self.env.current_player
+        return [self.policy_net if players[i] == 1 else opponent for i, opponent in enumerate(self.opponents)]
+
+    def step(self, eps_threshold):
+        """
+        全ゲームを1手進める。
+        戻り値: (X の手の経験 (states, actions, next_states, rewards, dones), 終わった局数)
+        """
+        env = self.env
+        state, mask = self.state, env.legal_mask()
+        ai_rows = env.current_player == 1
+        explore = ai_rows & (self.rng.random(env.num_envs) < eps_threshold)
+        actions = (self.rng.random(mask.shape) * mask).argmax(axis=1) # ε で選ばれた分はランダムな有効手
+
+        # ネットワークごとに行を集め、1回の forward で手を選ぶ（ランダムに打つ行は評価しない）
+        groups = {}
+        for i, net in enumerate(self._nets()):
+            if not explore[i]:
+                groups.setdefault(id(net), (net, []))[1].append(i)
+        # 学習中の policy_net も推論モードで評価する。学習モードの BatchNorm はバッチ全体の統計で正規化するので、
+        # 同じバッチに入ったほかのゲームによって手が変わり、移動平均も自己対戦の局面で更新されてしまう
+        was_training = self.policy_net.training
+        self.policy_net.eval()
+        try:
+            with torch.no_grad():
+                for net, rows in groups.values():
+                    q_values = net(torch.from_numpy(state[rows]).to(self.device))
+                    row_mask = torch.from_numpy(mask[rows]).to(self.device)
+                    actions[rows] = masked_argmax(q_values, row_mask).cpu().numpy()
+        finally:
+            self.policy_net.train(was_training)
+
+        self.state, rewards, dones, info = env.step(actions)
+        for i in np.flatnonzero(dones):
+            self.opponents[i] = self.choose_opponent()
+        transitions = (state[ai_rows], actions[ai_rows], info['terminal_state'][ai_rows],
+                       rewards[ai_rows].astype(np.float32), dones[ai_rows])
+        return transitions, int(dones.sum())
@@ -0,0 +1,348 @@
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from bitboard import get_tables
+from zobrist import TranspositionTable
+
+# ===============================================================
+# 設定（python tablebase.py で解析を実行。途中で止めても同じ設定で再開できる）
+# ===============================================================
+BOARD_SIZE = 5
+OUTPUT_DIR = f"fliptac_tablebase_{BOARD_SIZE}x{BOARD_SIZE}"
+SPLIT_PLY = 6       # この手数の局面をタスクとして各プロセスに配る
+CHUNK_SIZE = 64     # 1つのシャードファイルにまとめるタスク数
+NUM_WORKERS = os.cpu_count()
+# 表に保存する最大手数（None なら到達可能な全局面。4x4 までなら None で足りる）
+# 5x5 の全局面は数千億を超えて保存できないので、8手目まで（約174万局面、約40MB）に絞る。
+# それより深い局面は各プロセスの置換表だけで覚える。計測では手数6の局面1つあたり平均約1200万ノード・26秒（1コア）、
+# 84,504局面で合計およそ600 CPU時間かかる
+STORE_MAX_PLY = 8
+CACHE_SIZE_LOG2 = 22 # STORE_MAX_PLY より深い局面を覚えておく置換表の大きさ（プロセスごとに 2**n x 23 バイト）
+
+# ===============================================================
+# 局面のキーと値
+# キー: X の石 | O の石 << n | X の最後の手 << 2n | O の最後の手 << 2n+5（未着手は 31）
+#       手番は石の数から決まる（Xが先手）。0 は空き枠を表す。
+# 値  : 双方最善での終局までの手数。奇数なら手番側の勝ち、偶数なら負け（0 は打てる手がない）
+# ===============================================================
+_NO_MOVE = 31
+_EMPTY_KEY = 0
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+ENTRY_DTYPE = np.dtype([('key', '<u8'), ('value', 'u1')])
+
+
+def _pack(x_stones, o_stones, x_last, o_last, n):
+    return (x_stones | (o_stones << n)
+            | ((_NO_MOVE if x_last is None else x_last) << (2 * n))
+            | ((_NO_MOVE if o_last is None else o_last) << (2 * n + 5)))
+
+
+def position_key(position, size):
+    n = size * size
+    if 2 * n + 10 > 64: raise ValueError(f"{size}x{size} の局面は64bitのキーに収まりません")
+    return _pack(position.x_stones, position.o_stones, position.x_last, position.o_last, n)
+
+
+def is_win(value):
+    return value % 2 == 1
+
+
+def _slots(keys, log2_capacity):
+    with np.errstate(over='ignore'):
+        return ((np.asarray(keys, dtype=np.uint64) * _HASH_MULTIPLIER) >> np.uint64(64 - log2_capacity)).astype(np.int64)
+
+
+class Tablebase:
+    """
+    メモリマップした完全解析表（オープンアドレス法のハッシュ表）
+    開くときに読み込みは行わず、引くたびに必要なページだけがOSから読まれる。
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, 'tablebase.json')) as f:
+            meta = json.load(f)
+        self.size = meta['size']
+        self.entries = meta['entries']
+        self.table = np.load(os.path.join(directory, 'tablebase.npy'), mmap_mode='r')
+        self.log2_capacity = len(self.table).bit_length() - 1
+        self.mask = len(self.table) - 1
+
+    def lookup_key(self, key):
+        i = int(_slots([key], self.log2_capacity)[0])
+        keys = self.table['key']
+        while True:
+            k = int(keys[i])
+            if k == key: return int(self.table['value'][i])
+            if k == _EMPTY_KEY: return None
+            i = (i + 1) & self.mask
+
+    def lookup(self, position):
+        """局面の値（終局までの手数、奇数なら手番側の勝ち）を返す。表になければ None"""
+        return self.lookup_key(position_key(position, self.size))
+
+    def lookup_env(self, env):
+        return self.lookup(env.snapshot())
+
+
+class TablebasePlayer:
+    """
+    完全解析表で最善手を選ぶプレイヤー
+    勝てるなら最短で勝つ手、負けなら最も長引く手を選ぶ。表にない局面は fallback に任せる。
+    """
+    def __init__(self, tablebase, fallback=None):
+        self.tablebase = tablebase
+        self.fallback = fallback
+
+    def select_move(self, env):
+        moves = env.get_valid_moves(env.current_player)
+        if not moves: return None
+        best_move, best_score = None, None
+        for move in moves:
+            env.make_move(move)
+            value = self.tablebase.lookup_env(env)
+            env.unmake_move()
+            if value is None:
+                return self.fallback.select_move(env) if self.fallback is not None else moves[0]
+            # 相手から見て負け（偶数）の手を優先し、その中で短いもの。勝ち手がなければ長いもの
+            score = (0, value) if not is_win(value) else (1, -value)
+            if best_score is None or score < best_score:
+                best_move, best_score = move, score
+        return best_move
+
+
+# ===============================================================
+# 解析
+# ===============================================================
+class _Solver:
+    """
+    手番側から見た (自分の石, 相手の石, 自分の最後の手, 相手の最後の手) で全幅探索する
+    store_max_ply までの局面は memo（表に書き出すもの）に、それより深い局面は固定サイズの置換表に覚える。
+    """
+    def __init__(self, size, store_max_ply=None, cache_size_log2=CACHE_SIZE_LOG2):
+        self.size = size
+        self.n = size * size
+        tables = get_tables(size)
+        self.full, self.edge = tables.full, tables.edge
+        self.adjacent, self.jumps = tables.adjacent, tables.jumps
+        self.store_max_ply = store_max_ply
+        self.memo = {}
+        self.cache = TranspositionTable(cache_size_log2) if store_max_ply is not None else None
+        self.known = None # 手数が known_ply の局面の値を引く関数（上位の局面を解くときに使う）
+        self.known_ply = None
+
+    def key(self, me, opp, my_last, opp_last, x_to_move):
+        if x_to_move: return _pack(me, opp, my_last, opp_last, self.n)
+        return _pack(opp, me, opp_last, my_last, self.n)
+
+    def solve(self, me, opp, my_last, opp_last, x_to_move, ply):
+        key = self.key(me, opp, my_last, opp_last, x_to_move)
+        deep = self.store_max_ply is not None and ply > self.store_max_ply
+        if deep:
+            # キーに奇数を掛けても互いに異なるまま（64bit で可逆）なので、置換表の枠が偏らず取り違えもない
+            cache_key = (key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+            entry = self.cache.probe(cache_key)
+            if entry is not None: return int(entry[1])
+        else:
+            value = self.memo.get(key)
+            if value is not None: return value
+        if self.known is not None and ply == self.known_ply:
+            return self.known(key)
+
+        empty = self.full & ~(me | opp)
+        if my_last is None:
+            moves = self.edge & empty
+        else:
+            moves = self.adjacent[my_last]
+            for mid, dest in self.jumps[my_last]:
+                if opp & mid: moves |= dest
+            moves &= empty
+
+        shortest_win, longest_loss = None, -1
+        while moves:
+            low = moves & -moves
+            moves ^= low
+            child = self.solve(opp, me | low, opp_last, low.bit_length() - 1, not x_to_move, ply + 1)
+            if child % 2 == 0:
+                if shortest_win is None or child < shortest_win: shortest_win = child
+            elif child > longest_loss:
+                longest_loss = child
+        value = shortest_win + 1 if shortest_win is not None else longest_loss + 1
+
+        if deep:
+            # 残りのマスが多い（部分木が大きい）局面ほど置き換えられにくくする
+            self.cache.store(cache_key, self.n - ply, value, TranspositionTable.EXACT)
+        else:
+            self.memo[key] = value
+        return value
+
+
+def _positions_at_ply(size, ply):
+    """手数 ply で到達できる局面を、キーの順に並べて返す"""
+    tables = get_tables(size)
+    level = {(0, 0, None, None)}
+    for p in range(ply):
+        following = set()
+        for x_stones, o_stones, x_last, o_last in level:
+            x_to_move = p % 2 == 0
+            me, opp, my_last = (x_stones, o_stones, x_last) if x_to_move else (o_stones, x_stones, o_last)
+            empty = tables.full & ~(x_stones | o_stones)
+            if my_last is None:
+                moves = tables.edge & empty
+            else:
+                moves = tables.adjacent[my_last]
+                for mid, dest in tables.jumps[my_last]:
+                    if opp & mid: moves |= dest
+                moves &= empty
+            while moves:
+                low = moves & -moves
+                moves ^= low
+                i = low.bit_length() - 1
+                if x_to_move: following.add((x_stones | low, o_stones, i, o_last))
+                else: following.add((x_stones, o_stones | low, x_last, i))
+        level = following
+    n = size * size
+    return sorted(level, key=lambda s: _pack(*s, n))
+
+
+def _shard_path(output_dir, chunk):
+    return os.path.join(output_dir, 'shards', f"shard_{chunk:06d}.npy")
+
+
+def _check_manifest(output_dir, settings):
+    """
+    シャードを作ったときの設定を shards/manifest.json に記録し、再開時に同じ設定かを確かめる
+    設定が違うとシャード番号と局面の対応がずれるので、そのまま使わずにエラーにする。
+    """
+    shard_dir = os.path.join(output_dir, 'shards')
+    manifest_path = os.path.join(shard_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            recorded = json.load(f)
+        if recorded != settings:
+            raise ValueError(f"{shard_dir} のシャードは別の設定 {recorded} で作られています（今回 {settings}）。"
+                             "設定を戻すか、OUTPUT_DIR を変えてください")
+        return
+    if any(f.endswith('.npy') for f in os.listdir(shard_dir)):
+        raise ValueError(f"{shard_dir} に設定の記録がないシャードがあります。消してからやり直してください")
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(settings, f)
+    os.replace(tmp_path, manifest_path)
+
+
+def _save_atomic(path, array):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+_worker_tasks = None
+
+def _init_worker(size, split_ply):
+    global _worker_tasks
+    _worker_tasks = _positions_at_ply(size, split_ply)
+
+
+def _solve_chunk(args):
+    size, split_ply, chunk, chunk_size, store_max_ply, output_dir = args
+    solver = _Solver(size, store_max_ply)
+    x_to_move = split_ply % 2 == 0
+    for x_stones, o_stones, x_last, o_last in _worker_tasks[chunk * chunk_size:(chunk + 1) * chunk_size]:
+        if x_to_move: solver.solve(x_stones, o_stones, x_last, o_last, True, split_ply)
+        else: solver.solve(o_stones, x_stones, o_last, x_last, False, split_ply)
+    shard = np.empty(len(solver.memo), dtype=ENTRY_DTYPE)
+    shard['key'] = np.fromiter(solver.memo.keys(), dtype=np.uint64, count=len(solver.memo))
+    shard['value'] = np.fromiter(solver.memo.values(), dtype=np.uint8, count=len(solver.memo))
+    _save_atomic(_shard_path(output_dir, chunk), shard)
+    return chunk, len(shard)
+
+
+def _insert(table, entries, log2_capacity):
+    """ハッシュ表に (key, value) をまとめて挿入する（既にあるキーは飛ばす）"""
+    mask = len(table) - 1
+    keys, first = np.unique(entries['key'], return_index=True)
+    values = entries['value'][first]
+    slots = _slots(keys, log2_capacity)
+    inserted = 0
+    while len(keys):
+        current = table['key'][slots]
+        pending = current != keys # 同じキーが既にあれば挿入済み
+        empty = current == _EMPTY_KEY
+        # 空き枠に来たキーのうち、同じ枠を狙う中で最初のものだけを書き込む
+        _, winners = np.unique(slots[empty], return_index=True)
+        winners = np.flatnonzero(empty)[winners]
+        table['key'][slots[winners]] = keys[winners]
+        table['value'][slots[winners]] = values[winners]
+        inserted += len(winners)
+        pending[winners] = False
+        keys, values, slots = keys[pending], values[pending], (slots[pending] + 1) & mask
+    return inserted
+
+
+def solve(size=BOARD_SIZE, output_dir=OUTPUT_DIR, split_ply=SPLIT_PLY, chunk_size=CHUNK_SIZE,
+          num_workers=NUM_WORKERS, store_max_ply=STORE_MAX_PLY):
+    """
+    到達可能な局面を解析して output_dir に表を書き出す。
+    手数 split_ply の局面を chunk_size 個ずつシャードに分けて並列に解き、
+    書き終えたシャードは再実行時に飛ばす。最後にシャードと上位の局面をまとめて表にする。
+    """
+    if store_max_ply is not None and store_max_ply < split_ply:
+        raise ValueError("store_max_ply は split_ply 以上にしてください")
+    os.makedirs(os.path.join(output_dir, 'shards'), exist_ok=True)
+    _check_manifest(output_dir, {'size': size, 'split_ply': split_ply, 'chunk_size': chunk_size,
+                                 'store_max_ply': store_max_ply})
+    num_tasks = len(_positions_at_ply(size, split_ply))
+    num_chunks = (num_tasks + chunk_size - 1) // chunk_size
+    pending = [c for c in range(num_chunks) if not os.path.exists(_shard_path(output_dir, c))]
+    print(f"{num_tasks} positions at ply {split_ply} -> {num_chunks} chunks ({num_chunks - len(pending)} already done)")
+
+    start = time.perf_counter()
+    if pending:
+        args = [(size, split_ply, c, chunk_size, store_max_ply, output_dir) for c in pending]
+        with Pool(num_workers, initializer=_init_worker, initargs=(size, split_ply)) as pool:
+            for done, (chunk, entries) in enumerate(pool.imap_unordered(_solve_chunk, args), 1):
+                elapsed = time.perf_counter() - start
+                print(f"chunk {chunk} ({entries} entries) {done}/{len(pending)}, "
+                      f"eta {elapsed / done * (len(pending) - done):.0f}s", flush=True)
+
+    shards = [np.load(_shard_path(output_dir, c), mmap_mode='r') for c in range(num_chunks)]
+    capacity = 1 << max(int(np.ceil(np.log2(max(sum(len(s) for s in shards), 1) / 0.7 + 1))), 4)
+    log2_capacity = capacity.bit_length() - 1
+    tmp_path = os.path.join(output_dir, 'tablebase.npy.tmp')
+    table = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=ENTRY_DTYPE, shape=(capacity,))
+    table['key'] = _EMPTY_KEY
+    entries = sum(_insert(table, np.asarray(shard), log2_capacity) for shard in shards)
+
+    # split_ply より手前の局面は、シャードの値を引きながら解く
+    def known(key):
+        i = int(_slots([key], log2_capacity)[0])
+        while True:
+            k = int(table['key'][i])
+            if k == key: return int(table['value'][i])
+            if k == _EMPTY_KEY: raise KeyError(f"手数 {split_ply} の局面 {key:#x} がシャードにありません")
+            i = (i + 1) & (capacity - 1)
+    solver = _Solver(size, store_max_ply)
+    solver.known, solver.known_ply = known, split_ply
+    root_value = solver.solve(0, 0, None, None, True, 0)
+    top = np.empty(len(solver.memo), dtype=ENTRY_DTYPE)
+    top['key'] = list(solver.memo.keys())
+    top['value'] = list(solver.memo.values())
+    entries += _insert(table, top, log2_capacity)
+    table.flush()
+    del table
+    os.replace(tmp_path, os.path.join(output_dir, 'tablebase.npy'))
+    with open(os.path.join(output_dir, 'tablebase.json'), 'w') as f:
+        json.dump({'size': size, 'entries': entries, 'capacity': capacity, 'root_value': root_value}, f)
+    result = "first player wins" if is_win(root_value) else "second player wins"
+    print(f"{entries} positions, {result} in {root_value} plies")
+    return root_value
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1: BOARD_SIZE, OUTPUT_DIR = int(sys.argv[1]), f"fliptac_tablebase_{sys.argv[1]}x{sys.argv[1]}"
+    solve(BOARD_SIZE, OUTPUT_DIR)
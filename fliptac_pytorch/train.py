@@ -7,13 +7,19 @@ import random
 import math
 import os
 import re
-from collections import namedtuple, deque
+import sys
 from itertools import count
 from tqdm import tqdm
 
 # ローカルファイルからクラスをインポート
 from FlipTacEnv import FlipTacEnv
-from model import DQN
+from model import build_model, fuse_for_inference, masked_argmax, soft_update
+from replay import ReplayBuffer, PrioritizedReplayBuffer, saved_replay_dir
+from actor_learner import ActorPool
+from selfplay import LockstepSelfPlay
+from augment import DihedralAugmenter
+from checkpoint import CheckpointWriter, load_pool_index, to_cpu
+from metrics import ProfileWindow, TrainingMetrics
 
 # ===============================================================
 # 設定
@@ -26,109 +32,144 @@ EPS_END = 0.01   # 最終的にはほぼ活用
 EPS_DECAY = 100000 # より多くのエピソードをかけてゆっくり探索率を下げる
 # ▲▲▲ ここまで ▲▲▲
 TAU = 0.005
+TARGET_UPDATE_STEPS = 0 # 0なら1エピソードごと、1以上ならその回数の最適化ステップごとにターゲットネットワークを更新する
 LR = 1e-4
 BOARD_SIZE = 7
+MODEL_ARCH = 'dqn' # 'dqn'（従来のモデル）か 'conv'（全結合層のない、盤面サイズによらないモデル）
 NUM_EPISODES = 200000 # 学習エピソード数を大幅に増やす
 OPPONENT_POOL_SIZE = 10 # 対戦相手を保存するプールのサイズ
 SAVE_INTERVAL = 1000 # モデルを保存する間隔
-
-# ===============================================================
-# Replay Memory
-# ===============================================================
-Transition = namedtuple('Transition', ('state', 'action', 'next_state', 'reward'))
-class ReplayMemory(object):
-    def __init__(self, capacity):
-        self.memory = deque([], maxlen=capacity)
-    def push(self, *args):
-        self.memory.append(Transition(*args))
-    def sample(self, batch_size):
-        return random.sample(self.memory, batch_size)
-    def __len__(self):
-        return len(self.memory)
+MEMORY_CAPACITY = 10000 # Replay Memory の容量
+SAVE_REPLAY = True # チェックポイントと一緒に Replay Memory も保存し、再開時に読み込む
+REPLAY_DIR = "replay_memory" # Replay Memory の保存先（保存のたびに新しい番号のディレクトリへ書き、古いものは消す）
+USE_BITBOARD = True # 有効手の生成にビットボード版を使う
+PRIORITIZED_REPLAY = False # TD誤差の大きい経験を優先してサンプリングする
+PER_ALPHA = 0.6 # 優先度をどれだけ効かせるか（0で一様）
+PER_BETA_START = 0.4 # 重要度サンプリングの補正の強さ（学習の終わりに1まで上げる）
+NUM_ACTORS = 0 # 1以上なら自己対戦を別プロセスの actor に任せ、このプロセスは学習に専念する
+WEIGHT_SYNC_INTERVAL = 100 # actor に最新の重みを配る間隔（学習の更新回数）
+REPLAY_RATIO = 1.0 # NUM_ACTORS 使用時、受け取った経験1件あたりの学習の更新回数（1.0 なら1プロセスの学習と同じく AI の1手につき1回）
+LEARNER_TARGET_UPDATE_STEPS = 15 # NUM_ACTORS 使用時に TARGET_UPDATE_STEPS が0なら、この回数の最適化ステップごとにターゲットネットワークを更新する（7x7 の1局の AI の手数ほど）
+AUGMENT_SYMMETRY = False # サンプルした経験に盤面の回転・反転をランダムに掛ける
+LOCKSTEP_GAMES = 0 # 1以上なら、その数のゲームを同時に進めて推論をまとめる（1プロセスのまま）
+METRICS_PATH = "training_metrics.jsonl" # 段階ごとの時間や毎秒のstep数を追記するファイル（Noneなら書かない）
+METRICS_LOG_PATH = "training.log" # 集計の要約を書くログ（ローテーションする）
+METRICS_INTERVAL = 30 # 集計を書き出す間隔（秒）
+PROFILE_MODE = None # 'torch' か 'cprofile' にすると、下のエピソードの間だけプロファイルを取る
+PROFILE_START_EPISODE = 100
+PROFILE_EPISODES = 20
 
 # ===============================================================
 # 初期化 & チェックポイントからの再開
 # ===============================================================
-env = FlipTacEnv(size=BOARD_SIZE)
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Using device: {device}")
+def setup():
+    """
+    モデル、Replay Memory、対戦相手プールを用意し、チェックポイントがあれば続きから再開する
+    学習を始める前に1回だけ呼ぶ（spawn で起動した actor がこのファイルを読み込んでも、ここは実行されない）
+    """
+    global env, device, policy_net, target_net, optimizer, memory, augmenter, metrics, profile_window
+    global steps_done, optimizer_steps, start_episode, opponent_pool, checkpoint_writer
+    env = FlipTacEnv(size=BOARD_SIZE, use_bitboard=USE_BITBOARD)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print(f"Using device: {device}")
 
-policy_net = DQN(BOARD_SIZE, BOARD_SIZE).to(device)
-target_net = DQN(BOARD_SIZE, BOARD_SIZE).to(device)
-optimizer = optim.AdamW(policy_net.parameters(), lr=LR, amsgrad=True)
-memory = ReplayMemory(10000)
-steps_done = 0
-start_episode = 0
+    policy_net = build_model(MODEL_ARCH, BOARD_SIZE, BOARD_SIZE).to(device)
+    target_net = build_model(MODEL_ARCH, BOARD_SIZE, BOARD_SIZE).to(device)
+    optimizer = optim.AdamW(policy_net.parameters(), lr=LR, amsgrad=True)
+    if PRIORITIZED_REPLAY:
+        memory = PrioritizedReplayBuffer(MEMORY_CAPACITY, (3, BOARD_SIZE, BOARD_SIZE), device, alpha=PER_ALPHA)
+    else:
+        memory = ReplayBuffer(MEMORY_CAPACITY, (3, BOARD_SIZE, BOARD_SIZE), device)
+    augmenter = DihedralAugmenter(BOARD_SIZE, device)
+    metrics = TrainingMetrics(METRICS_PATH, METRICS_LOG_PATH, METRICS_INTERVAL)
+    profile_window = ProfileWindow(PROFILE_MODE, PROFILE_START_EPISODE, PROFILE_EPISODES)
+    steps_done = 0
+    optimizer_steps = 0
+    start_episode = 0
 
-checkpoint_dir = '.'
-files = os.listdir(checkpoint_dir)
-checkpoints = [f for f in files if f.startswith('fliptac_dqn_episode_') and f.endswith('.pth')]
+    checkpoint_dir = '.'
+    files = os.listdir(checkpoint_dir)
+    checkpoints = [f for f in files if f.startswith('fliptac_dqn_episode_') and f.endswith('.pth')]
 
-if checkpoints:
-    latest_episode = -1
-    latest_checkpoint_file = None
-    for ckpt in checkpoints:
-        match = re.search(r'episode_(\d+)\.pth', ckpt)
-        if match:
-            episode_num = int(match.group(1))
-            if episode_num > latest_episode:
-                latest_episode, latest_checkpoint_file = episode_num, ckpt
+    if checkpoints:
+        latest_episode = -1
+        latest_checkpoint_file = None
+        for ckpt in checkpoints:
+            match = re.search(r'episode_(\d+)\.pth', ckpt)
+            if match:
+                episode_num = int(match.group(1))
+                if episode_num > latest_episode:
+                    latest_episode, latest_checkpoint_file = episode_num, ckpt
     
-    if latest_checkpoint_file:
-        print(f"Resuming training from checkpoint: {latest_checkpoint_file}")
+        if latest_checkpoint_file:
+            print(f"Resuming training from checkpoint: {latest_checkpoint_file}")
         
-        # ▼▼▼ ここが重要な修正箇所です ▼▼▼
-        try:
-            # 新しい形式（辞書）での読み込みを試みる
-            checkpoint = torch.load(latest_checkpoint_file)
-            if isinstance(checkpoint, dict):
-                policy_net.load_state_dict(checkpoint['policy_net_state_dict'])
-                optimizer.load_state_dict(checkpoint.get('optimizer_state_dict', optimizer.state_dict()))
-                steps_done = checkpoint.get('steps_done', 0)
-            else:
-                # 辞書でなければ古い形式と判断
+            # ▼▼▼ ここが重要な修正箇所です ▼▼▼
+            try:
+                # 新しい形式（辞書）での読み込みを試みる
+                checkpoint = torch.load(latest_checkpoint_file)
+                if isinstance(checkpoint, dict):
+                    # 別の種類のモデルの重みは読み込めないので、ここで止める（sys.exit は下の except で捕まらない）
+                    checkpoint_arch = checkpoint.get('model_arch', 'dqn')
+                    if checkpoint_arch != MODEL_ARCH:
+                        sys.exit(f"{latest_checkpoint_file} is a '{checkpoint_arch}' model but MODEL_ARCH is '{MODEL_ARCH}'. "
+                                 "Set MODEL_ARCH to match or move the old checkpoints away.")
+                    policy_net.load_state_dict(checkpoint['policy_net_state_dict'])
+                    optimizer.load_state_dict(checkpoint.get('optimizer_state_dict', optimizer.state_dict()))
+                    steps_done = checkpoint.get('steps_done', 0)
+                else:
+                    # 辞書でなければ古い形式と判断
+                    policy_net.load_state_dict(checkpoint)
+                    print("Warning: Loaded an old checkpoint format. Optimizer state and steps_done are not restored.")
+            except Exception as e:
+                # weights_only=False/True の問題を吸収するためのフォールバック
+                print(f"Could not load checkpoint with default method due to {e}. Trying with weights_only=True.")
+                checkpoint = torch.load(latest_checkpoint_file, weights_only=True)
                 policy_net.load_state_dict(checkpoint)
                 print("Warning: Loaded an old checkpoint format. Optimizer state and steps_done are not restored.")
-        except Exception as e:
-            # weights_only=False/True の問題を吸収するためのフォールバック
-            print(f"Could not load checkpoint with default method due to {e}. Trying with weights_only=True.")
-            checkpoint = torch.load(latest_checkpoint_file, weights_only=True)
-            policy_net.load_state_dict(checkpoint)
-            print("Warning: Loaded an old checkpoint format. Optimizer state and steps_done are not restored.")
-        # ▲▲▲ 修正ここまで ▲▲▲
+            # ▲▲▲ 修正ここまで ▲▲▲
         
-        start_episode = latest_episode
-        print(f"Resumed from episode {start_episode}.")
+            start_episode = latest_episode
+            print(f"Resumed from episode {start_episode}.")
 
-target_net.load_state_dict(policy_net.state_dict())
-target_net.eval()
+            # 保存しておいた Replay Memory があれば、メモリマップで読み込んで続きから使う
+            if SAVE_REPLAY and saved_replay_dir(REPLAY_DIR):
+                try:
+                    memory.load(REPLAY_DIR)
+                    print(f"Loaded {len(memory)} transitions from {REPLAY_DIR}.")
+                except (ValueError, OSError, KeyError) as e:
+                    print(f"Warning: Could not load replay memory. Error: {e}")
 
+    target_net.load_state_dict(policy_net.state_dict())
+    target_net.eval()
 
 
-# ▼▼▼ フェーズ2: 対戦相手プールの初期化 ▼▼▼
-opponent_pool = []
-opponent_dir = "opponent_pool"
-if os.path.exists(opponent_dir):
-    for f in os.listdir(opponent_dir):
-        if f.endswith(".pth"):
-            try:
-                opponent_net = DQN(BOARD_SIZE, BOARD_SIZE).to(device)
-                # ファイルを辞書形式として読み込みを試みる
-                checkpoint = torch.load(os.path.join(opponent_dir, f))
-                
-                # 辞書形式か、重みデータそのものかを判別
-                if isinstance(checkpoint, dict):
-                    # 新しい辞書形式の場合
-                    opponent_net.load_state_dict(checkpoint['policy_net_state_dict'])
-                else:
-                    # 古い形式の場合
-                    opponent_net.load_state_dict(checkpoint)
-                
-                opponent_pool.append(opponent_net)
-            except Exception as e:
-                print(f"Warning: Could not load opponent model {f}. Error: {e}")
 
-print(f"Loaded {len(opponent_pool)} opponents into the pool.")
+    # ▼▼▼ フェーズ2: 対戦相手プールの初期化 ▼▼▼
+    opponent_pool = []
+    opponent_dir = "opponent_pool"
+    # index.json に記録されたファイルだけを古い順に読み込む（書きかけのファイルは記録されていない）
+    for f in load_pool_index(opponent_dir):
+        try:
+            opponent_net = build_model(MODEL_ARCH, BOARD_SIZE, BOARD_SIZE).to(device)
+            # ファイルを辞書形式として読み込みを試みる
+            checkpoint = torch.load(os.path.join(opponent_dir, f))
+        
+            # 辞書形式か、重みデータそのものかを判別
+            if isinstance(checkpoint, dict):
+                # 新しい辞書形式の場合
+                opponent_net.load_state_dict(checkpoint['policy_net_state_dict'])
+            else:
+                # 古い形式の場合
+                opponent_net.load_state_dict(checkpoint)
+        
+            # プールの相手は重みが変わらないので、BatchNorm を畳み込んだ推論用の複製にしておく
+            opponent_pool.append(fuse_for_inference(opponent_net))
+        except Exception as e:
+            print(f"Warning: Could not load opponent model {f}. Error: {e}")
+
+    print(f"Loaded {len(opponent_pool)} opponents into the pool.")
+    checkpoint_writer = CheckpointWriter(opponent_dir, OPPONENT_POOL_SIZE)
 
 # ▲▲▲ ここまで ▲▲▲
 
@@ -145,149 +186,261 @@ def select_action(state):
     steps_done += 1
     if sample > eps_threshold:
         with torch.no_grad():
-            q_values = policy_net(state)
-            valid_moves = env.get_valid_moves(env.current_player)
-            if not valid_moves: return None
-            mask = torch.full((BOARD_SIZE * BOARD_SIZE,), -float('inf'), device=device)
-            for r, c in valid_moves:
-                mask[r * BOARD_SIZE + c] = 0.0
-            action_q_values = q_values.view(-1) + mask
-            action_idx = action_q_values.argmax().item()
+            with metrics.phase('policy_forward'):
+                q_values = policy_net(state)
+            with metrics.phase('legal_mask'):
+                mask = env.legal_mask()
+            if not mask.any(): return None
+            action_idx = masked_argmax(q_values, torch.from_numpy(mask).to(device).unsqueeze(0)).item()
             return (action_idx // BOARD_SIZE, action_idx % BOARD_SIZE)
     else:
         valid_moves = env.get_valid_moves(env.current_player)
         return random.choice(valid_moves) if valid_moves else None
 
-def optimize_model():
+def optimize_model(progress=1.0):
     if len(memory) < BATCH_SIZE: return
-    transitions = memory.sample(BATCH_SIZE)
-    batch = Transition(*zip(*transitions))
-    non_final_mask = torch.tensor(tuple(map(lambda s: s is not None, batch.next_state)), device=device, dtype=torch.bool)
-    non_final_next_states = torch.cat([s for s in batch.next_state if s is not None])
-    state_batch = torch.cat(batch.state)
-    action_batch = torch.tensor([a[0] * BOARD_SIZE + a[1] for a in batch.action], device=device).unsqueeze(1)
-    reward_batch = torch.cat(batch.reward)
-    state_action_values = policy_net(state_batch).gather(1, action_batch)
-    next_state_values = torch.zeros(BATCH_SIZE, device=device)
+    with metrics.phase('optimize'): # 中の replay_sample と target_update の時間は含まない
+        _optimize_model(progress)
+
+def _optimize_model(progress):
+    global optimizer_steps
+    with metrics.phase('replay_sample'):
+        if PRIORITIZED_REPLAY:
+            beta = PER_BETA_START + (1.0 - PER_BETA_START) * progress
+            state_batch, action_batch, next_state_batch, reward_batch, done_batch, weights, indices = memory.sample(BATCH_SIZE, beta)
+        else:
+            state_batch, action_batch, next_state_batch, reward_batch, done_batch = memory.sample(BATCH_SIZE)
+    if AUGMENT_SYMMETRY:
+        state_batch, action_batch, next_state_batch = augmenter(state_batch, action_batch, next_state_batch)
+    state_action_values = policy_net(state_batch).gather(1, action_batch.unsqueeze(1))
     with torch.no_grad():
-        next_state_values[non_final_mask] = target_net(non_final_next_states).max(1)[0]
+        # target_net は推論モードなので、終局の経験もまとめて流してから0にする
+        next_state_values = target_net(next_state_batch).max(1)[0].masked_fill(done_batch, 0.0)
     expected_state_action_values = (next_state_values * GAMMA) + reward_batch
-    criterion = nn.SmoothL1Loss()
-    loss = criterion(state_action_values, expected_state_action_values.unsqueeze(1))
+    criterion = nn.SmoothL1Loss(reduction='none')
+    losses = criterion(state_action_values, expected_state_action_values.unsqueeze(1)).squeeze(1)
+    if PRIORITIZED_REPLAY:
+        loss = (losses * weights).mean()
+        td_errors = (expected_state_action_values - state_action_values.squeeze(1)).detach()
+        memory.update_priorities(indices, td_errors.cpu().numpy())
+    else:
+        loss = losses.mean()
     optimizer.zero_grad()
     loss.backward()
     torch.nn.utils.clip_grad_value_(policy_net.parameters(), 100)
     optimizer.step()
+    optimizer_steps += 1
+    metrics.count('optimizer_steps')
+    interval = target_update_interval()
+    if interval and optimizer_steps % interval == 0:
+        with metrics.phase('target_update'):
+            soft_update(target_net, policy_net, TAU)
+
+def target_update_interval():
+    """
+    ターゲットネットワークを更新する最適化ステップの間隔（0なら1エピソードごと）
+    actor を使うときはエピソードの数が学習の更新回数と結びつかないので、常に更新回数で数える。
+    """
+    if TARGET_UPDATE_STEPS or NUM_ACTORS <= 0: return TARGET_UPDATE_STEPS
+    return LEARNER_TARGET_UPDATE_STEPS
+
+def choose_opponent():
+    # プールが空か、25%の確率で最新の自分自身と対戦します
+    if not opponent_pool or random.random() < 0.25:
+        return target_net # 最新の自分（target_netはpolicy_netの安定版）
+    return random.choice(opponent_pool).eval()
+
+def finish_episode(i_episode):
+    """
+    1局終わるごとに呼ぶ。ターゲットネットワークの更新（更新回数で数えるときは optimize_model の中で行う）、
+    チェックポイントの保存、計測の書き出しを行う。保存したときは対戦相手プールに加えた相手を返す
+    """
+    metrics.count('episodes')
+    if not target_update_interval():
+        with metrics.phase('target_update'):
+            soft_update(target_net, policy_net, TAU)
+    new_opponent = None
+    if (i_episode + 1) % SAVE_INTERVAL == 0:
+        with metrics.phase('checkpoint'):
+            new_opponent = save_checkpoint(i_episode)
+    metrics.log_if_due(i_episode + 1, replay_fill=len(memory) / MEMORY_CAPACITY, steps_done=steps_done)
+    profile_window.step(i_episode + 1)
+    return new_opponent
+
+def save_checkpoint(i_episode):
+    """
+    チェックポイントと対戦相手プールへの保存を書き出しスレッドに任せ、
+    メモリ内の対戦相手プールに今の policy_net を加える。加えた相手を返す
+    """
+    # 書き出し中も学習を続けられるよう、CPU に写したものを渡す
+    policy_state = to_cpu(policy_net.state_dict())
+    checkpoint_writer.save({'policy_net_state_dict': policy_state, 'optimizer_state_dict': to_cpu(optimizer.state_dict()),
+                            'steps_done': steps_done, 'model_arch': MODEL_ARCH}, f"fliptac_dqn_episode_{i_episode+1}.pth")
+    checkpoint_writer.add_opponent(policy_state, f"opponent_{i_episode+1}.pth")
+    if SAVE_REPLAY:
+        # 書き出しも別スレッドで行う。今の位置と件数を控えて渡し、書き出し中に入った経験は保存に含めない
+        checkpoint_writer.run(memory.save, REPLAY_DIR, memory.snapshot())
+    
+    # メモリ内のopponent_poolも更新（推論用の複製。満杯なら一番古い相手を外す）
+    # 外した相手は上書きしない。同時に進めている対局（LOCKSTEP_GAMES）がまだ使っていることがあり、
+    # 書き換えると対局の途中で相手が入れ替わってしまう。どの対局からも使われなくなれば解放される
+    if len(opponent_pool) >= OPPONENT_POOL_SIZE:
+        opponent_pool.pop(0)
+    new_opponent = fuse_for_inference(policy_net)
+    opponent_pool.append(new_opponent)
+    return new_opponent
+
+def train_lockstep():
+    """
+    LOCKSTEP_GAMES 局を同時に進め、1手ごとに同じネットワークの推論を1回にまとめる
+    学習は従来どおり AI の1手につき1回、ソフト更新と保存は1局終わるごとに行う。
+    """
+    global steps_done
+    selfplay = LockstepSelfPlay(LOCKSTEP_GAMES, BOARD_SIZE, policy_net, choose_opponent, device)
+    i_episode = start_episode
+    progress = tqdm(desc="Training Progress", initial=start_episode, total=NUM_EPISODES)
+    while i_episode < NUM_EPISODES:
+        eps_threshold = EPS_END + (EPS_START - EPS_END) * math.exp(-1. * steps_done / EPS_DECAY)
+        with metrics.phase('selfplay_tick'):
+            transitions, episodes = selfplay.step(eps_threshold)
+        metrics.count('env_steps', LOCKSTEP_GAMES)
+        with metrics.phase('replay_push'):
+            memory.push_batch(*transitions)
+        for _ in range(len(transitions[1])):
+            steps_done += 1
+            optimize_model(i_episode / NUM_EPISODES)
+        for _ in range(min(episodes, NUM_EPISODES - i_episode)):
+            finish_episode(i_episode)
+            i_episode += 1
+            progress.update()
+    progress.close()
+
+def train_actor_learner():
+    """
+    NUM_ACTORS 個のプロセスに自己対戦させ、このプロセスは届いた経験で学習する（learner）
+    届いた経験1件につき REPLAY_RATIO 回更新し終えるまで次の経験は受け取らないので、
+    learner が遅ければ actor はキューが詰まって待ち、1プロセスの学習と同じ割合で更新が進む。
+    WEIGHT_SYNC_INTERVAL 回の更新ごとに最新の重みを actor へ配る。
+    """
+    global steps_done
+    actors = ActorPool(NUM_ACTORS, BOARD_SIZE, OPPONENT_POOL_SIZE, EPS_START, EPS_END, EPS_DECAY,
+                       steps_done=steps_done, use_bitboard=USE_BITBOARD, model_arch=MODEL_ARCH)
+    for opponent in opponent_pool:
+        actors.publish_opponent(opponent)
+    actors.publish_weights(policy_net)
+    actors.start()
+    i_episode = start_episode
+    updates = 0
+    pending_updates = 0.0 # 受け取った経験に対してまだ行っていない更新の回数
+    progress = tqdm(desc="Training Progress", initial=start_episode, total=NUM_EPISODES)
+    try:
+        while i_episode < NUM_EPISODES:
+            with metrics.phase('drain'):
+                transitions, episodes = actors.drain(memory, block=True)
+            metrics.count('transitions', transitions)
+            steps_done = actors.steps_done.value
+            # 1プロセスの学習と同じく、経験が BATCH_SIZE 件溜まるまでの手は更新に数えない
+            if len(memory) >= BATCH_SIZE:
+                pending_updates += transitions * REPLAY_RATIO
+            while pending_updates >= 1:
+                optimize_model(i_episode / NUM_EPISODES)
+                pending_updates -= 1
+                updates += 1
+                if updates % WEIGHT_SYNC_INTERVAL == 0:
+                    actors.publish_weights(policy_net)
+            for _ in range(min(episodes, NUM_EPISODES - i_episode)):
+                new_opponent = finish_episode(i_episode)
+                if new_opponent is not None:
+                    actors.publish_opponent(new_opponent)
+                i_episode += 1
+                progress.update()
+    finally:
+        actors.close()
+        progress.close()
 
 
 # ===============================================================
 # 学習ループ
 # ===============================================================
 if __name__ == '__main__':
-    # tqdmを使って、学習の進捗をプログレスバーで表示します
-    for i_episode in tqdm(range(start_episode, NUM_EPISODES), desc="Training Progress", initial=start_episode, total=NUM_EPISODES):
+    setup()
+    profile_window.step(start_episode)
+    if NUM_ACTORS > 0:
+        train_actor_learner()
+    elif LOCKSTEP_GAMES > 0:
+        train_lockstep()
+    else:
+        # tqdmを使って、学習の進捗をプログレスバーで表示します
+        for i_episode in tqdm(range(start_episode, NUM_EPISODES), desc="Training Progress", initial=start_episode, total=NUM_EPISODES):
         
-        # ▼▼▼ フェーズ2: 対戦相手をプールからランダムに選択 ▼▼▼
-        # プールが空か、25%の確率で最新の自分自身と対戦します
-        if not opponent_pool or random.random() < 0.25:
-            opponent_net = target_net # 最新の自分（target_netはpolicy_netの安定版）
-        else:
-            opponent_net = random.choice(opponent_pool)
-        opponent_net.eval() # 相手モデルを推論モードに設定
-        # ▲▲▲ ここまで ▲▲▲
+            # ▼▼▼ フェーズ2: 対戦相手をプールからランダムに選択 ▼▼▼
+            opponent_net = choose_opponent()
+            opponent_net.eval() # 相手モデルを推論モードに設定
+            # ▲▲▲ ここまで ▲▲▲
         
-        # ゲーム環境をリセットして、最初の盤面状態を取得
-        state = env.reset()
-        state = torch.tensor(state, dtype=torch.float32, device=device).unsqueeze(0)
+            # ゲーム環境をリセットして、最初の盤面状態を取得
+            observation = env.reset()
+            state = torch.tensor(observation, dtype=torch.float32, device=device).unsqueeze(0)
         
-        # 1エピソード（1ゲーム）が終わるまでループ
-        for t in count():
-            # 現在のプレイヤーがAI(1)か相手(-1)かで使うモデルを切り替える
-            if env.current_player == 1:
-                # 自分のターン：学習中のpolicy_netを使って行動を選択
-                action = select_action(state)
-            else: # 相手のターン
-                with torch.no_grad(): # 勾配計算は不要
-                    # 相手もDQNモデルとして手を選択する
-                    q_values = opponent_net(state)
-                    valid_moves = env.get_valid_moves(env.current_player)
-                    if not valid_moves:
-                        action = None
-                        break
+            # 1エピソード（1ゲーム）が終わるまでループ
+            for t in count():
+                # 現在のプレイヤーがAI(1)か相手(-1)かで使うモデルを切り替える
+                if env.current_player == 1:
+                    # 自分のターン：学習中のpolicy_netを使って行動を選択
+                    action = select_action(state)
+                else: # 相手のターン
+                    with torch.no_grad(): # 勾配計算は不要
+                        # 相手もDQNモデルとして手を選択する
+                        with metrics.phase('opponent_forward'):
+                            q_values = opponent_net(state)
+                        with metrics.phase('legal_mask'):
+                            mask = env.legal_mask()
+                        if not mask.any():
+                            action = None
+                            break
                     
-                    # 有効な手以外は選択しないようにマスクをかける
-                    mask = torch.full((BOARD_SIZE * BOARD_SIZE,), -float('inf'), device=device)
-                    for r, c in valid_moves:
-                        mask[r * BOARD_SIZE + c] = 0.0
-                    action_idx = (q_values.view(-1) + mask).argmax().item()
-                    action = (action_idx // BOARD_SIZE, action_idx % BOARD_SIZE)
+                        # 有効な手以外は選択しないようにマスクをかける（マスクの転送は1回だけ）
+                        action_idx = masked_argmax(q_values, torch.from_numpy(mask).to(device).unsqueeze(0)).item()
+                        action = (action_idx // BOARD_SIZE, action_idx % BOARD_SIZE)
 
-            # どちらかのプレイヤーが打つ手がなくなったらエピソード終了
-            if action is None:
-                break
+                # どちらかのプレイヤーが打つ手がなくなったらエピソード終了
+                if action is None:
+                    break
             
-            # AIの行動(player=1)のターンかどうかを記録
-            is_ai_turn = env.current_player == 1
+                # AIの行動(player=1)のターンかどうかを記録
+                is_ai_turn = env.current_player == 1
             
-            # 選択した行動を環境に渡し、次の状態、報酬、終了フラグを受け取る
-            observation, reward, done, _ = env.step(action)
+                # 選択した行動を環境に渡し、次の状態、報酬、終了フラグを受け取る
+                prev_observation = observation
+                with metrics.phase('env_step'):
+                    observation, reward, done, _ = env.step(action)
+                metrics.count('env_steps')
             
-            # AIのターンに得られた経験だけをReplay Memoryに保存
-            if is_ai_turn:
-                reward = torch.tensor([reward], device=device)
-                next_state = None if done else torch.tensor(observation, dtype=torch.float32, device=device).unsqueeze(0)
-                memory.push(state, action, next_state, reward)
+                # AIのターンに得られた経験だけをReplay Memoryに保存
+                if is_ai_turn:
+                    with metrics.phase('replay_push'):
+                        memory.push(prev_observation, action[0] * BOARD_SIZE + action[1], observation, reward, done)
 
-            # 次の状態に更新
-            state = None if done else torch.tensor(observation, dtype=torch.float32, device=device).unsqueeze(0)
+                # 次の状態に更新
+                state = None if done else torch.tensor(observation, dtype=torch.float32, device=device).unsqueeze(0)
             
-            # AIのターンだった場合のみ、モデルの最適化（学習）を実行
-            if is_ai_turn:
-                optimize_model()
+                # AIのターンだった場合のみ、モデルの最適化（学習）を実行
+                if is_ai_turn:
+                    optimize_model(i_episode / NUM_EPISODES)
 
-            # ゲームが終了したらエピソードのループを抜ける
-            if done:
-                break
+                # ゲームが終了したらエピソードのループを抜ける
+                if done:
+                    break
         
-        # ターゲットネットワークの重みをゆっくりと更新する
-        target_net_state_dict = target_net.state_dict()
-        policy_net_state_dict = policy_net.state_dict()
-        for key in policy_net_state_dict:
-            target_net_state_dict[key] = policy_net_state_dict[key]*TAU + target_net_state_dict[key]*(1-TAU)
-        target_net.load_state_dict(target_net_state_dict)
-
-        # ▼▼▼ チェックポイント保存と、対戦相手プールの更新 ▼▼▼
-        if (i_episode + 1) % SAVE_INTERVAL == 0:
-            # メインのチェックポイントを保存
-            save_path = f"fliptac_dqn_episode_{i_episode+1}.pth"
-            torch.save({'policy_net_state_dict': policy_net.state_dict(), 'optimizer_state_dict': optimizer.state_dict(), 'steps_done': steps_done}, save_path)
-            
-            # 対戦相手プール用のフォルダがなければ作成
-            if not os.path.exists(opponent_dir):
-                os.makedirs(opponent_dir)
-            pool_save_path = os.path.join(opponent_dir, f"opponent_{i_episode+1}.pth")
-            
-            # 対戦相手も辞書形式で保存する
-            torch.save({'policy_net_state_dict': policy_net.state_dict()}, pool_save_path)
-            
-            # プールが満杯なら一番古いものを削除
-            opponent_files = os.listdir(opponent_dir)
-            if len(opponent_files) > OPPONENT_POOL_SIZE:
-                oldest_file = min(opponent_files, key=lambda f: int(re.search(r'_(\d+)\.pth', f).group(1)))
-                os.remove(os.path.join(opponent_dir, oldest_file))
-            
-            # メモリ内のopponent_poolも更新
-            new_opponent = DQN(BOARD_SIZE, BOARD_SIZE).to(device)
-            new_opponent.load_state_dict(policy_net.state_dict())
-            if len(opponent_pool) >= OPPONENT_POOL_SIZE:
-                opponent_pool.pop(0)
-            opponent_pool.append(new_opponent)
-        # ▲▲▲ ここまで ▲▲▲
-
+            # ターゲットネットワークの更新、チェックポイント保存と対戦相手プールの更新
+            finish_episode(i_episode)
 
+    profile_window.stop()
     print('Complete')
-    torch.save({
-        'policy_net_state_dict': policy_net.state_dict(),
-        'optimizer_state_dict': optimizer.state_dict(),
+    checkpoint_writer.save({
+        'policy_net_state_dict': to_cpu(policy_net.state_dict()),
+        'optimizer_state_dict': to_cpu(optimizer.state_dict()),
         'steps_done': steps_done,
-    }, "fliptac_dqn_final.pth")
\ No newline at end of file
+        'model_arch': MODEL_ARCH,
+    }, "fliptac_dqn_final.pth")
+    checkpoint_writer.close()
\ No newline at end of file
@@ -0,0 +1,106 @@
+import random
+from array import array
+from functools import lru_cache
+
+
+class ZobristKeys:
+    """
+    局面のZobristハッシュ用の乱数表
+    マスの石、両プレイヤーの最後の手（未着手を含む）、手番のそれぞれに64bitの乱数を割り当てる。
+    """
+    def __init__(self, size, seed=0):
+        rng = random.Random(f"fliptac-zobrist-{size}-{seed}")
+        n = size * size
+        self.size = size
+        self.cells = {p: [rng.getrandbits(64) for _ in range(n)] for p in (1, -1)}
+        self.last = {p: [rng.getrandbits(64) for _ in range(n + 1)] for p in (1, -1)} # 最後の要素が未着手
+        self.side = rng.getrandbits(64) # O(-1)の手番のときにXORする
+        self.initial = self.last[1][n] ^ self.last[-1][n]
+
+    def last_key(self, player, last_pos):
+        if last_pos is None: return self.last[player][self.size * self.size]
+        return self.last[player][last_pos[0] * self.size + last_pos[1]]
+
+    def hash_position(self, position):
+        """FlipTacEnv.snapshot() の Position からハッシュを計算し直す"""
+        h = 0
+        n = self.size * self.size
+        for player, stones, last in ((1, position.x_stones, position.x_last), (-1, position.o_stones, position.o_last)):
+            while stones:
+                low = stones & -stones
+                h ^= self.cells[player][low.bit_length() - 1]
+                stones ^= low
+            h ^= self.last[player][n if last is None else last]
+        if position.current_player == -1: h ^= self.side
+        return h
+
+
+@lru_cache(maxsize=None)
+def get_keys(size):
+    return ZobristKeys(size)
+
+
+class TranspositionTable:
+    """
+    固定サイズの置換表（エントリ数は 2**size_log2）
+    エントリは型付き配列に並べて持ち、保存のたびにオブジェクトを作らない。
+    同じ枠に別の局面が来た場合は、前回以前の探索で保存されたものか、
+    探索深さが同じか浅いものだけを置き換える。
+    """
+    EXACT, LOWER, UPPER = 0, 1, 2
+
+    def __init__(self, size_log2=20):
+        self.mask = (1 << size_log2) - 1
+        self.clear()
+
+    def clear(self):
+        n = self.mask + 1
+        self.keys = array('Q', bytes(8 * n))
+        self.depths = array('h', [-1]) * n # -1 は空き
+        self.values = array('d', bytes(8 * n))
+        self.flags = array('b', bytes(n))
+        self.moves = array('h', [-1]) * n # (row << 8) | col、-1 は最善手なし
+        self.generations = array('H', bytes(2 * n))
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def new_search(self):
+        """探索の開始ごとに呼ぶ。古い世代のエントリが優先して置き換えられる"""
+        self.generation = (self.generation + 1) & 0xFFFF
+
+    def probe(self, key):
+        """(depth, value, flag, best_move) を返す。見つからなければ None"""
+        i = key & self.mask
+        if self.depths[i] >= 0 and self.keys[i] == key:
+            self.hits += 1
+            move = self.moves[i]
+            return self.depths[i], self.values[i], self.flags[i], None if move < 0 else (move >> 8, move & 0xFF)
+        self.misses += 1
+        return None
+
+    def store(self, key, depth, value, flag, best_move=None):
+        i = key & self.mask
+        if self.depths[i] < 0 or self.keys[i] == key or self.generations[i] != self.generation or depth >= self.depths[i]:
+            self.keys[i] = key
+            self.depths[i] = depth
+            self.values[i] = value
+            self.flags[i] = flag
+            self.moves[i] = -1 if best_move is None else (best_move[0] << 8) | best_move[1]
+            self.generations[i] = self.generation
+            self.stores += 1
+
+    def stats(self):
+        probes = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'stores': self.stores,
+                'hit_rate': self.hits / probes if probes else 0.0}
+
+
+_shared_tables = {}
+
+def get_shared_table(size_log2=20):
+    """探索型のCPUプレイヤーが共有する置換表"""
+    if size_log2 not in _shared_tables:
+        _shared_tables[size_log2] = TranspositionTable(size_log2)
+    return _shared_tables[size_log2]
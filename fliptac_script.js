@@ -457,6 +457,24 @@ async function cpu_logic_lv3(board, cpuMark, opponentMark, last_move, size) {
     const tensor = new ort.Tensor('float32', inputTensor, [1, 3, size, size]);
     const feeds = { 'input': tensor };
 
+    // export_onnx.py の EXPORT_MASKED で書き出したモデルなら、有効手の中から手を選ぶところまでモデルが行う
+    if (session.inputNames.includes('last_move') || session.inputNames.includes('mask')) {
+        if (session.inputNames.includes('last_move')) {
+            // AIが最後に置いたマスだけ1（初手ならすべて0）。有効手はモデルの中で求める
+            const lastMovePlane = new Float32Array(size * size);
+            if (last_move[cpuMark]) lastMovePlane[last_move[cpuMark][0] * size + last_move[cpuMark][1]] = 1.0;
+            feeds['last_move'] = new ort.Tensor('float32', lastMovePlane, [1, 1, size, size]);
+        } else {
+            const mask = new Uint8Array(size * size);
+            for (let r = 0; r < size; r++) { for (let c = 0; c < size; c++) { if (isValidMove(cpuMark, r, c)) mask[r * size + c] = 1; } }
+            feeds['mask'] = new ort.Tensor('bool', mask, [1, size * size]);
+        }
+        const results = await session.run(feeds);
+        const action = Number(results.action.data[0]);
+        if (results.output.data[action] === -Infinity) return null; // 有効な手がない
+        return [Math.floor(action / size), action % size];
+    }
+
     // 2. モデルで推論を実行
     const results = await session.run(feeds);
     const qValues = results.output.data;